@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import math
+import random
+import argparse
+import time
+import json
+import csv
+
+# Never open a window.
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import numpy
+
+import futracer
+import futcubes
+import futfly
+import futdoomlib.runner
+
+
+def walking_camera(position, step, turn):
+    # Walk forwards while slowly turning, like holding the up and one of the
+    # left/right arrow keys.
+    def camera(i):
+        x, y, z = position
+        angle = 0.0
+        for _ in range(i):
+            x += step * math.sin(angle)
+            z += step * math.cos(angle)
+            angle += turn
+        return ((x, y, z), (0.0, angle, 0.0))
+    return camera
+
+def make_cubes(render_approach):
+    return futcubes.FutCubes(render_approach=render_approach)
+
+def make_fly(render_approach):
+    return futfly.FutFly(render_approach=render_approach)
+
+def make_doom(render_approach):
+    return futdoomlib.runner.Doom(futracer, level_path=None,
+                                  render_approach=render_approach)
+
+apps = {
+    'futcubes': (make_cubes, walking_camera((0.0, 0.0, 0.0), 15.0, 0.01)),
+    'futfly': (make_fly, walking_camera((15000.0, -500.0, 0.0), 10.0, 0.0)),
+    'futdoom': (make_doom, walking_camera((700.0, -180.0, 700.0), 5.0, 0.02)),
+}
+
+def percentiles(samples):
+    xs = numpy.array(samples, dtype='float64')
+    return {
+        'count': len(xs),
+        'mean_ms': float(numpy.mean(xs)),
+        'p50_ms': float(numpy.percentile(xs, 50)),
+        'p90_ms': float(numpy.percentile(xs, 90)),
+        'p99_ms': float(numpy.percentile(xs, 99)),
+        'max_ms': float(numpy.max(xs)),
+    }
+
+def timed(f, *args):
+    time_start = time.time()
+    result = f(*args)
+    time_end = time.time()
+    return result, (time_end - time_start) * 1000
+
+class Benchmark:
+    def __init__(self, app_names, render_approaches, sizes, frames, warmup,
+                 setup_runs, seed, use_grid=True, backend=None):
+        self.app_names = app_names
+        self.render_approaches = render_approaches
+        self.sizes = sizes
+        self.frames = frames
+        self.warmup = warmup
+        self.setup_runs = setup_runs
+        self.seed = seed
+        self.use_grid = use_grid
+        self.backend = backend
+        self.rows = []
+
+    def add_row(self, app_name, stage, samples, n_triangles,
+                render_approach='', size=None):
+        row = {
+            'app': app_name,
+            'render_approach': render_approach,
+            'width': size[0] if size else '',
+            'height': size[1] if size else '',
+            'triangles': n_triangles,
+            'stage': stage,
+        }
+        row.update(percentiles(samples))
+        self.rows.append(row)
+        print('{} {} {} {}: p50 {:.02f} ms, p90 {:.02f} ms'.format(
+            app_name, render_approach or '-',
+            '{}x{}'.format(*size) if size else '-', stage,
+            row['p50_ms'], row['p90_ms']), file=sys.stderr)
+
+    def run(self):
+        self.racer = futracer.FutRacer(self.backend)
+        print('Using the {} backend'.format(self.racer.backend),
+              file=sys.stderr)
+        for app_name in self.app_names:
+            self.run_app(app_name)
+        return self.rows
+
+    def run_app(self, app_name):
+        make_app, camera_path = apps[app_name]
+        app = make_app(self.render_approaches[0])
+        app.racer = self.racer
+
+        random.seed(self.seed)
+        triangles, textures = app.make_scene()
+
+        preprocess_ms = []
+        upload_ms = []
+        for _ in range(self.setup_runs):
+            (triangles_pre, textures_pre), t = timed(
+                app.preprocess_scene, triangles, textures)
+            preprocess_ms.append(t)
+            time_start = time.time()
+            if self.use_grid:
+                scene = self.racer.upload_grid_scene(
+                    triangles_pre, textures_pre,
+                    app.grid_cell_size, app.grid_origo)
+            else:
+                scene = self.racer.upload_scene(triangles_pre, textures_pre)
+            self.racer.sync()
+            upload_ms.append((time.time() - time_start) * 1000)
+        n_triangles = len(triangles_pre[0])
+        self.add_row(app_name, 'preprocess', preprocess_ms, n_triangles)
+        self.add_row(app_name, 'upload', upload_ms, n_triangles)
+
+        for render_approach in self.render_approaches:
+            # Use the same settings as the program itself would, but keep the
+            # number of draw rectangles fixed.
+            settings = make_app(render_approach)
+            planner = futracer.FramePlanner(self.racer)
+            planner.tune_draw_rects = False
+            if render_approach == 'auto':
+                planner.cost_model.calibrate(
+                    self.racer, scene, camera_path(0), self.sizes[0],
+                    settings.view_dist, settings.draw_dist,
+                    settings.n_draw_rects)
+            for size in self.sizes:
+                render_ms = []
+                readback_ms = []
+                predicted_ms = []
+                for i in range(self.warmup + self.frames):
+                    time_start = time.time()
+                    approach, n_draw_rects, ranges, tag = planner.plan(
+                        size, settings.view_dist, settings.draw_dist,
+                        camera_path(i), scene, render_approach,
+                        settings.n_draw_rects)
+                    frame = self.racer.render_scene(
+                        size, settings.view_dist, settings.draw_dist,
+                        camera_path(i), scene, approach, n_draw_rects, ranges)
+                    self.racer.sync()
+                    time_end = time.time()
+                    self.racer.from_device(frame)
+                    time_end_get = time.time()
+                    planner.report(tag, (time_end_get - time_start) * 1000)
+                    if i >= self.warmup:
+                        render_ms.append((time_end - time_start) * 1000)
+                        readback_ms.append((time_end_get - time_end) * 1000)
+                        if planner.predicted_ms is not None:
+                            predicted_ms.append(planner.predicted_ms)
+                self.add_row(app_name, 'render', render_ms, n_triangles,
+                             render_approach, size)
+                self.add_row(app_name, 'readback', readback_ms, n_triangles,
+                             render_approach, size)
+                if predicted_ms:
+                    # Compare with render plus readback.
+                    self.add_row(app_name, 'predicted', predicted_ms,
+                                 n_triangles, render_approach, size)
+
+def write_rows(rows, out, output_format):
+    if output_format == 'json':
+        json.dump(rows, out, indent=2)
+        out.write('\n')
+    else:
+        writer = csv.DictWriter(out, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+def main(args):
+    def size(s):
+        return tuple(map(int, s.split('x')))
+
+    arg_parser = argparse.ArgumentParser(description='Benchmark the example programs without opening a window.  Results are written to standard out, and a summary to standard error.')
+    arg_parser.add_argument('--apps', nargs='+', choices=list(apps.keys()),
+                            default=list(apps.keys()),
+                            help='the programs whose scenes to benchmark (defaults to all of them)')
+    arg_parser.add_argument('--render-approaches', nargs='+',
+                            choices=futracer.render_approaches,
+                            default=futracer.render_approaches,
+                            help='the rendering approaches to benchmark (defaults to all of them)')
+    arg_parser.add_argument('--sizes', nargs='+', type=size,
+                            metavar='WIDTHxHEIGHT',
+                            default=[(320, 240), (640, 360), (800, 600)],
+                            help='the frame sizes to benchmark')
+    arg_parser.add_argument('--frames', type=futracer.positive, default=60,
+                            help='the number of measured frames per setting (defaults to 60)')
+    arg_parser.add_argument('--warmup', type=futracer.non_negative, default=5,
+                            help='the number of unmeasured frames before each setting (defaults to 5)')
+    arg_parser.add_argument('--setup-runs', type=futracer.positive, default=5,
+                            help='how many times to measure preprocessing and uploading (defaults to 5)')
+    arg_parser.add_argument('--seed', type=int, default=0,
+                            help='the random seed for building the scenes (defaults to 0)')
+    arg_parser.add_argument('--no-grid', dest='use_grid', action='store_false',
+                            help='render all static triangles instead of only those in the grid cells in view')
+    arg_parser.add_argument('--backend',
+                            choices=['auto'] + futracer.futhark_backends,
+                            help='the Futhark backend to render with (defaults to $FUTRACER_BACKEND, or the first one that works)')
+    arg_parser.add_argument('--format', choices=['json', 'csv'], default='json',
+                            help='the output format (defaults to json)')
+    arg_parser.add_argument('--output', metavar='PATH',
+                            help='write the results to this file instead')
+
+    args = arg_parser.parse_args(args)
+
+    benchmark = Benchmark(args.apps, args.render_approaches, args.sizes,
+                          args.frames, args.warmup, args.setup_runs, args.seed,
+                          args.use_grid, args.backend)
+    rows = benchmark.run()
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            write_rows(rows, f, args.format)
+    else:
+        write_rows(rows, sys.stdout, args.format)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
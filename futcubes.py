@@ -5,8 +5,9 @@ import os.path
 import math
 import random
 import argparse
-import time
+import functools
 
+import numpy
 import pygame
 
 import futracer
@@ -14,7 +15,8 @@ import futracer
 
 class FutCubes:
     def __init__(self, size=None, n_cubes=None, just_colors=False,
-                 render_approach=None):
+                 render_approach=None, pipeline=False, frame_budget=None,
+                 render_scale=1.0, min_render_scale=None, backend=None):
         if size is None:
             size = (800, 600)
         self.size = size
@@ -27,9 +29,18 @@ class FutCubes:
         self.render_approach = render_approach
         self.view_dist = 600.0
         self.draw_dist = 8000.0
-        if render_approach != 'segmented':
+        if render_approach in ('chunked', 'scatter_bbox'):
             self.draw_dist /= 10 # The others are really that much slower.
         self.n_draw_rects = [1, 1]
+        self.grid_cell_size = 2000.0
+        self.grid_origo = None
+        self.camera_start = ((0.0, 0.0, 0.0), (0.0, 0.0, 0.0))
+        self.pipeline = pipeline
+        self.frame_budget = frame_budget
+        self.render_scale = render_scale
+        self.min_render_scale = min_render_scale
+        self.backend = backend
+        self.frame_surface = None
 
     def run(self):
         # Setup pygame.
@@ -41,11 +52,23 @@ class FutCubes:
         self.clock = pygame.time.Clock()
 
         # Load the library.
-        self.racer = futracer.FutRacer()
+        self.racer = futracer.FutRacer(self.backend)
 
         # Actually run!
         return self.loop()
 
+    def record(self, path, n_frames=None, camera_path=None,
+               record_format='raw'):
+        self.racer = futracer.FutRacer(self.backend)
+        scene = self.upload()
+        cameras = futracer.recording_cameras(camera_path, n_frames,
+                                             self.camera_start)
+        futracer.record_frames(self.racer, scene, self.size, self.view_dist,
+                               self.draw_dist, cameras, path, record_format,
+                               self.render_approach, self.n_draw_rects,
+                               self.render_scale, self.update_scene)
+        return 0
+
     def message(self, what, where):
         text = self.font.render(what, 1, (255, 255, 255))
         self.screen.blit(text, where)
@@ -58,25 +81,29 @@ class FutCubes:
               (400.0, 100.0, 200.0),
               (200.0, 300.0, 200.0)]
         origo = (300.0, 200.0, 300.0)
-        s0 = [t0, t1]
-        s1 = [[self.racer.rotate_point((0.0, math.pi / 2, 0.0), origo, p) for p in t]
-              for t in s0]
-        s2 = [[self.racer.rotate_point((0.0, -math.pi / 2, 0.0), origo, p) for p in t]
-              for t in s0]
-        s3 = [[self.racer.rotate_point((0.0, math.pi, 0.0), origo, p) for p in t]
-              for t in s0]
-        s4 = [[self.racer.rotate_point((math.pi / 2, 0.0, 0.0), origo, p) for p in t]
-              for t in s0]
-        s5 = [[self.racer.rotate_point((-math.pi / 2, 0.0, 0.0), origo, p) for p in t]
-              for t in s0]
-        half_cube_0 = s0 + s1 + s2 + s3 + s4 + s5
+        s0 = numpy.array(t0 + t1, dtype='float32')
+        sides_angles = [(0.0, math.pi / 2, 0.0),
+                        (0.0, -math.pi / 2, 0.0),
+                        (0.0, math.pi, 0.0),
+                        (math.pi / 2, 0.0, 0.0),
+                        (-math.pi / 2, 0.0, 0.0)]
+        s1_5 = self.racer.rotate_points(
+            numpy.repeat(numpy.array(sides_angles, dtype='float32'),
+                         len(s0), axis=0),
+            origo,
+            numpy.tile(s0, (len(sides_angles), 1)))
+        half_cube_0 = numpy.concatenate((s0, s1_5))
+        n_half_cube_points = len(half_cube_0)
+        n_half_cube_triangles = n_half_cube_points // 3
 
         if square_texture is not None:
             textures = [square_texture]
         else:
             textures = []
 
-        half_cubes = []
+        moves = numpy.empty((self.n_cubes, 3), dtype='float32')
+        angles = numpy.empty((self.n_cubes, 3), dtype='float32')
+        hsvs = numpy.zeros((self.n_cubes, 3), dtype='float32')
         xr = 30000.0
         yr = 1000.0
         zr = 30000.0
@@ -87,46 +114,96 @@ class FutCubes:
             ax = random.random() * math.pi
             ay = random.random() * math.pi
             az = random.random() * math.pi
-            if square_texture is not None:
-                def make_surf(i):
-                    surf = (2, (0.0, 0.0, 0.0), i % 2)
-                    return surf
-            else:
+            moves[i] = (xm, ym, zm)
+            angles[i] = (ax, ay, az)
+            if square_texture is None:
                 # Use a random color.
-                hsv = (random.random() * 360.0,
-                       random.random(),
-                       random.random())
-                surf = (1, hsv, -1)
-                make_surf = lambda i: surf
-            def move_point(p):
-                return self.racer.rotate_point(
-                    (ax, ay, az),
-                    self.racer.translate_point((xm, ym, zm), origo),
-                    self.racer.translate_point((xm, ym, zm), p))
-            half_cube = [[move_point(p) for p in t] + [make_surf(i)]
-                         for t, i in
-                         zip(half_cube_0, range(len(half_cube_0)))]
-            half_cubes.extend(half_cube)
-
-        return half_cubes, textures
+                hsvs[i] = (random.random() * 360.0,
+                           random.random(),
+                           random.random())
+
+        # Move and rotate the points of all cubes in one go.
+        points_moved = self.racer.translate_points(
+            numpy.repeat(moves, n_half_cube_points, axis=0),
+            numpy.tile(half_cube_0, (self.n_cubes, 1)))
+        points = self.racer.rotate_points(
+            numpy.repeat(angles, n_half_cube_points, axis=0),
+            numpy.repeat(moves + numpy.array(origo, dtype='float32'),
+                         n_half_cube_points, axis=0),
+            points_moved)
+        vertices = numpy.reshape(points, (-1, 3, 3))
+
+        surfaces = numpy.zeros(len(vertices), dtype=futracer.surface_dtype)
+        if square_texture is not None:
+            surfaces['type'] = 2
+            surfaces['index'] = numpy.tile(
+                numpy.arange(n_half_cube_triangles) % 2, self.n_cubes)
+        else:
+            surfaces['type'] = 1
+            surfaces['hsv'] = numpy.repeat(hsvs, n_half_cube_triangles, axis=0)
+            surfaces['index'] = -1
 
-    def loop(self):
+        return (vertices, surfaces), textures
+
+    def make_scene(self):
         if self.just_colors:
-            triangles, textures = self.random_cubes()
+            return self.random_cubes()
         else:
             base_dir = os.path.dirname(__file__)
-            sonic_texture = self.racer.load_double_texture(
+            sonic_texture = self.racer.load_double_texture_rgb8(
                 os.path.join(base_dir, 'data/futcubes/sonic-texture.png'))
             textures_size = (100, 100)
             assert (textures_size[0], textures_size[1], 3) == sonic_texture.shape
-            triangles, textures = self.random_cubes(sonic_texture)
+            return self.random_cubes(sonic_texture)
+
+    def preprocess_scene(self, triangles, textures):
+        return (self.racer.preprocess_triangles_arrays(*triangles),
+                self.racer.preprocess_textures(textures))
+
+    def upload(self):
+        triangles, textures = self.make_scene()
 
         # The objects will not change (only the camera changes), so we
         # preprocess them to save important loop time.
-        triangles_pre = self.racer.preprocess_triangles(triangles)
-        textures_pre = self.racer.preprocess_textures(textures)
+        triangles_pre, textures_pre = self.preprocess_scene(triangles, textures)
+        # They also stay in the Futhark context between frames.  Only the
+        # spinning triangle is sent along with each frame.
+        return self.racer.upload_grid_scene(triangles_pre, textures_pre,
+                                            self.grid_cell_size,
+                                            self.grid_origo)
+
+    def update_scene(self, scene, i):
+        dynamic_points = numpy.array([[-300, -300, 500],
+                                      [300, -300, 500],
+                                      [0, 300, 400]], dtype='float32')
+        # The spinning triangle is seen from both sides.
+        dynamic_surfaces = numpy.array([(1 | futracer.surface_double_sided,
+                                         (240, 1, 1), 0)],
+                                       dtype=futracer.surface_dtype)
+        dynamic_origo = (0, 0, 450)
+
+        dynamic_angles = (i / 60.0, i / 80.0, i / 100.0)
+        dynamic_vertices = self.racer.rotate_points(
+            dynamic_angles, dynamic_origo, dynamic_points)
+        scene.set_layer('spinning', self.racer.preprocess_triangles_arrays(
+            numpy.reshape(dynamic_vertices, (1, 3, 3)), dynamic_surfaces))
+
+    def loop(self):
+        scene = self.upload()
 
-        camera = [[0.0, 0.0, 0.0], [0.0, 0.0, 0.0]]
+        pipeline = futracer.FramePipeline(self.racer, self.pipeline)
+        try:
+            return self.run_frames(scene, pipeline)
+        finally:
+            pipeline.close()
+
+    def run_frames(self, scene, pipeline):
+        planner = futracer.FramePlanner(self.racer)
+        if self.frame_budget is not None:
+            budget = futracer.FrameBudget(
+                self.frame_budget, min_render_scale=self.min_render_scale)
+
+        camera = [list(self.camera_start[0]), list(self.camera_start[1])]
 
         keys_holding = {}
         for x in [pygame.K_UP, pygame.K_DOWN, pygame.K_LEFT, pygame.K_RIGHT,
@@ -141,34 +218,47 @@ class FutCubes:
 
         for i in inf_range():
             fps = self.clock.get_fps()
-            time_start = time.time()
-
-            dynamic_triangle = [[-300, -300, 500],
-                                [300, -300, 500],
-                                [0, 300, 400],
-                                [1, [240, 1, 1], 0]]
-            dynamic_origo = [0, 0, 450]
-            dynamic_angles = [i / 60.0, i / 80.0, i / 100.0]
-            dynamic_triangle = self.racer.rotate_triangle(
-                dynamic_angles, dynamic_origo, dynamic_triangle)
-
-            frame = self.racer.render_triangles(
-                self.size, self.view_dist, self.draw_dist, camera,
-                [dynamic_triangle], triangles_pre,
-                None, textures_pre, self.render_approach, self.n_draw_rects)
-            time_end = time.time()
-            frame = frame.get()
-            futhark_dur_ms = (time_end - time_start) * 1000
-            pygame.surfarray.blit_array(self.surface, frame)
-            self.screen.blit(self.surface, (0, 0))
-
-            self.message('FPS: {:.02f}'.format(fps), (10, 10))
-            self.message('Futhark: {:.02f} ms'.format(futhark_dur_ms), (10, 40))
-            self.message('Draw distance: {:.02f}'.format(self.draw_dist), (10, 70))
-            self.message('Rendering approach: {}'.format(self.render_approach), (10, 100))
-            if self.render_approach == 'chunked':
-                self.message('# draw rects: x: {}, y: {}'.format(
-                    *self.n_draw_rects), (10, 130))
+
+            self.update_scene(scene, i)
+
+            camera_now = (tuple(camera[0]), tuple(camera[1]))
+            render_approach, n_draw_rects, ranges, tag = planner.plan(
+                self.size, self.view_dist, self.draw_dist, camera_now, scene,
+                self.render_approach, self.n_draw_rects, self.render_scale)
+            self.n_draw_rects = list(n_draw_rects)
+
+            frame = pipeline.push(functools.partial(
+                self.racer.render_scene,
+                self.size, self.view_dist, self.draw_dist, camera_now,
+                scene.copy(), render_approach, n_draw_rects, ranges,
+                self.render_scale), tag)
+            if frame is not None:
+                futhark_dur_ms = pipeline.render_ms + pipeline.get_ms
+                planner.report(pipeline.tag, futhark_dur_ms)
+                if self.frame_budget is not None:
+                    self.draw_dist, self.render_scale = budget.update(
+                        futhark_dur_ms, self.draw_dist, self.render_scale)
+                self.frame_surface = futracer.present_frame(
+                    self.surface, frame, self.frame_surface)
+                self.screen.blit(self.surface, (0, 0))
+
+                self.message('FPS: {:.02f}'.format(fps), (10, 10))
+                self.message('Futhark: {:.02f} ms'.format(futhark_dur_ms), (10, 40))
+                self.message('Draw distance: {:.02f}{}'.format(
+                    self.draw_dist,
+                    ' (auto)' if self.frame_budget is not None else ''), (10, 70))
+                self.message('Rendering approach: {}'.format(self.render_approach), (10, 100))
+                self.message('Render scale: {:.02f}{}'.format(
+                    self.render_scale,
+                    ' (auto)' if self.min_render_scale is not None else ''), (10, 190))
+                if planner.predicted_ms is not None:
+                    self.message('Chosen: {} (predicted: {:.02f} ms, actual: {:.02f} ms)'.format(
+                        planner.render_approach, planner.predicted_ms,
+                        planner.actual_ms), (10, 130))
+                if planner.render_approach == 'chunked':
+                    self.message('# draw rects: x: {}, y: {}{}'.format(
+                        *self.n_draw_rects,
+                        ' (auto)' if planner.tune_draw_rects else ''), (10, 160))
 
             pygame.display.flip()
 
@@ -187,13 +277,21 @@ class FutCubes:
                         self.render_approach = futracer.next_elem(futracer.render_approaches,
                                                                   self.render_approach)
 
+                    if event.key == pygame.K_3:
+                        self.render_scale = max(0.25, self.render_scale - 0.05)
+                    if event.key == pygame.K_4:
+                        self.render_scale = min(1.0, self.render_scale + 0.05)
                     if event.key == pygame.K_a:
+                        planner.tune_draw_rects = False
                         self.n_draw_rects[0] = max(1, self.n_draw_rects[0] - 1)
                     if event.key == pygame.K_d:
+                        planner.tune_draw_rects = False
                         self.n_draw_rects[0] = self.n_draw_rects[0] + 1
                     if event.key == pygame.K_w:
+                        planner.tune_draw_rects = False
                         self.n_draw_rects[1] = max(1, self.n_draw_rects[1] - 1)
                     if event.key == pygame.K_s:
+                        planner.tune_draw_rects = False
                         self.n_draw_rects[1] = self.n_draw_rects[1] + 1
 
                 elif event.type == pygame.KEYUP:
@@ -244,12 +342,21 @@ def main(args):
                             choices=futracer.render_approaches,
                             default='segmented',
                             help='choose how to render a frame')
+    futracer.add_app_arguments(arg_parser)
 
     args = arg_parser.parse_args(args)
 
     cubes = FutCubes(size=args.size, n_cubes=args.cubes,
                      just_colors=args.just_colors,
-                     render_approach=args.render_approach)
+                     render_approach=args.render_approach,
+                     pipeline=args.pipeline,
+                     frame_budget=args.frame_budget,
+                     render_scale=args.render_scale,
+                     min_render_scale=args.min_render_scale,
+                     backend=args.backend)
+    if args.record is not None:
+        return cubes.record(args.record, args.frames, args.camera_path,
+                            args.record_format)
     return cubes.run()
 
 if __name__ == '__main__':
@@ -1,6 +1,17 @@
 import argparse
 
 import futdoomlib.runner as runner
+import futdoomlib.resources as resources
+
+def precompile(futracer, map_paths):
+    # Compiling is plain NumPy, so this works without a built futracerlib.
+    for map_path in map_paths:
+        doom = runner.Doom(futracer, level_path=map_path)
+        (triangles_pre, _, _), cached = doom.load_compiled_map()
+        print('{}: {} triangles{}'.format(
+            map_path, len(triangles_pre[0]),
+            ' (already compiled)' if cached else ''))
+    return 0
 
 def main(futracer, args):
     def size(s):
@@ -15,13 +26,35 @@ def main(futracer, args):
                             choices=futracer.render_approaches,
                             default='segmented',
                             help='choose how to render a frame')
+    arg_parser.add_argument('--precompile', nargs='*', metavar='MAP',
+                            help='compile these maps (defaults to all maps in data/futdoom/maps) into the cache, so that they load faster, and exit')
+    arg_parser.add_argument('--stream', action='store_true',
+                            help='only load the part of the map within draw distance, and load the rest in the background while moving (for very large maps)')
+    arg_parser.add_argument('--stream-budget', type=int, default=128,
+                            metavar='MIB',
+                            help='keep at most this many MiB of map triangles loaded when streaming (defaults to 128)')
     arg_parser.add_argument('--auto-fps',
                             action='store_true',
-                            help='automatically keep the FPS high by dynamically lowering the draw distance (experimental)')
+                            help='the same as --frame-budget 20')
+    futracer.add_app_arguments(arg_parser)
     args = arg_parser.parse_args(args)
+    if args.auto_fps and args.frame_budget is None:
+        args.frame_budget = 20.0
+
+    if args.precompile is not None:
+        return precompile(futracer, args.precompile or resources.maps_paths)
 
     doom = runner.Doom(futracer, level_path=args.level_path,
                        scale_to=args.scale_to,
                        render_approach=args.render_approach,
-                       auto_fps=args.auto_fps)
+                       frame_budget=args.frame_budget,
+                       render_scale=args.render_scale,
+                       min_render_scale=args.min_render_scale,
+                       pipeline=args.pipeline,
+                       backend=args.backend,
+                       stream=args.stream,
+                       stream_budget=args.stream_budget)
+    if args.record is not None:
+        return doom.record(args.record, args.frames, args.camera_path,
+                           args.record_format)
     return doom.run()
@@ -0,0 +1,92 @@
+import os
+import os.path
+import json
+import hashlib
+
+import numpy
+
+# A compiled map is a directory with the preprocessed triangles of a map, one
+# .npy file per array, and a manifest with the paths of the double textures the
+# triangles use, in the order of their texture indices.  The triangles are
+# stored sorted by the cells of their spatial grid, and the per-cell arrays of
+# the grid are stored next to them, so that nothing has to be sorted on load.
+# The arrays are memory-mapped when loaded, so even large maps load in
+# milliseconds.
+
+format_version = 2
+
+triangle_array_names = ['x0s', 'y0s', 'z0s', 'x1s', 'y1s', 'z1s',
+                        'x2s', 'y2s', 'z2s',
+                        's_types', 's_hsv_hs', 's_hsv_ss', 's_hsv_vs',
+                        's_indices']
+
+grid_array_names = ['cell_starts', 'cell_mins', 'cell_maxs', 'cell_areas']
+
+def compiled_map_key(map_path, texture_paths, map_cell_size, grid_cell_size,
+                     grid_origo, grid_block):
+    # Changes whenever the map file, the set of textures (whose order decides
+    # the texture indices) or the size of the map or grid cells changes.
+    h = hashlib.sha1()
+    h.update('futdoom-map:{}:{}:{}:{}:{}:{}\n'.format(
+        format_version, map_cell_size, grid_cell_size, *grid_origo,
+        grid_block).encode('utf-8'))
+    for path in texture_paths:
+        h.update(os.path.abspath(path).encode('utf-8') + b'\n')
+    with open(map_path, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+def compiled_map_path(cache_dir, key):
+    return os.path.join(cache_dir, 'maps', key)
+
+def save_compiled_map(path, triangles_pre, texture_paths, grid,
+                      map_path=None):
+    # Write to a temporary directory first, so that a half-written map is never
+    # loaded.
+    path_tmp = '{}.{}.tmp'.format(path, os.getpid())
+    os.makedirs(path_tmp, exist_ok=True)
+    for name, xs in zip(triangle_array_names, triangles_pre):
+        numpy.save(os.path.join(path_tmp, name + '.npy'), xs)
+    for name in grid_array_names:
+        numpy.save(os.path.join(path_tmp, name + '.npy'), getattr(grid, name))
+    manifest = {
+        'version': format_version,
+        'map': map_path,
+        'n_triangles': len(triangles_pre[0]),
+        'arrays': triangle_array_names,
+        'textures': [os.path.abspath(path) for path in texture_paths],
+        'grid': {
+            'cell_size': grid.cell_size,
+            'origo': [float(x) for x in grid.origo],
+            'n_cells_xz': [grid.n_x, grid.n_z],
+            'block': grid.block,
+        },
+    }
+    with open(os.path.join(path_tmp, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    try:
+        os.rename(path_tmp, path)
+    except OSError:
+        # Another process got there first.
+        for name in os.listdir(path_tmp):
+            os.remove(os.path.join(path_tmp, name))
+        os.rmdir(path_tmp)
+
+def load_compiled_map(path):
+    # Returns the triangles, the texture paths and the arguments of the
+    # SpatialGrid over the triangles, or None if there is no usable compiled
+    # map at path.
+    try:
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest['version'] != format_version:
+            return None
+        triangles_pre = tuple(
+            numpy.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+            for name in manifest['arrays'])
+        grid_args = dict(manifest['grid'])
+        for name in grid_array_names:
+            grid_args[name] = numpy.load(os.path.join(path, name + '.npy'))
+    except (OSError, ValueError, KeyError):
+        return None
+    return triangles_pre, manifest['textures'], grid_args
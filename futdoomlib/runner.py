@@ -1,126 +1,271 @@
 import sys
 import os.path
-import time
+import functools
 
+import numpy
 import pygame
 
 import futdoomlib.resources as resources
 import futdoomlib.mapper as mapper
-
-def square2d_to_triangles2d(square2d):
-    left_upper, right_lower = square2d
-    x_lu, y_lu = left_upper
-    x_rl, y_rl = right_lower
-    return [
-        [(x_lu, y_lu), (x_lu, y_rl), (x_rl, y_lu)],
-        [(x_rl, y_rl), (x_rl, y_lu), (x_lu, y_rl)]
-    ]
+import futdoomlib.compiled as compiled
+import futdoomlib.streaming as streaming
 
 class Doom:
     def __init__(self, racer_module, level_path, scale_to=None,
-                 render_approach=None, auto_fps=False):
+                 render_approach=None, frame_budget=None, pipeline=False,
+                 render_scale=1.0, min_render_scale=None, backend=None,
+                 stream=False, stream_budget=128):
         self.racer_module = racer_module
         self.level_path = level_path
         self.scale_to = scale_to
         self.render_approach = render_approach
         if render_approach is None:
             render_approach = 'segmented'
-        self.auto_fps = auto_fps
+        self.frame_budget = frame_budget
+        self.render_scale = render_scale
+        self.min_render_scale = min_render_scale
+        self.backend = backend
+        self.stream = stream
+        self.stream_budget = stream_budget
+        self.streamer = None
+        self.frame_surface = None
+        self.pipeline = pipeline
         self.size = (640, 360)
         self.view_dist = 400.0
         self.draw_dist = 20000.0
-        if render_approach != 'segmented':
+        if render_approach in ('chunked', 'scatter_bbox'):
             self.draw_dist /= 10 # The others are really that much slower.
         self.n_draw_rects = [1, 1]
+        # Use blocks of 4x4 map cells, aligned with the map cell walls.
+        self.map_cell_size = 200
+        self.grid_cell_size = self.map_cell_size * 4
+        self.grid_origo = (-self.map_cell_size / 2, -self.map_cell_size / 2)
+        # Order the grid in blocks of 4x4 grid cells, i.e. 16x16 map cells.
+        # These are the chunks of the map when streaming.
+        self.grid_block = 4
+        self.camera_start = ((700.0, -180.0, 700.0), (0.0, 0.0, 0.0))
 
     def run(self):
-        self.racer = self.racer_module.FutRacer()
-        self.load_resources()
+        self.racer = self.racer_module.FutRacer(self.backend)
+        self.load_resources(self.stream)
         self.setup_screen()
-        self.loop()
+        try:
+            self.loop()
+        finally:
+            if self.streamer is not None:
+                self.streamer.close()
+
+    def record(self, path, n_frames=None, camera_path=None,
+               record_format='raw'):
+        self.racer = self.racer_module.FutRacer(self.backend)
+        self.load_resources()
+        cameras = self.racer_module.recording_cameras(camera_path, n_frames,
+                                                      self.camera_start)
+        self.racer_module.record_frames(
+            self.racer, self.scene, self.size, self.view_dist, self.draw_dist,
+            cameras, path, record_format, self.render_approach,
+            self.n_draw_rects, self.render_scale)
+        return 0
+
+    def load_resources(self, stream=False):
+        (triangles_pre, texture_paths, grid), _ = self.load_compiled_map()
+        textures_pre = self.load_textures(texture_paths)
+        if stream:
+            # Only keep the part of the map around the camera in the Futhark
+            # context; loop moves it along with the camera.
+            self.streamer = streaming.ChunkStreamer(
+                self.racer, triangles_pre, textures_pre, grid,
+                self.stream_budget * 2**20)
+            self.scene = self.streamer.start(self.camera_start, self.size,
+                                             self.view_dist, self.draw_dist)
+        else:
+            self.scene = self.racer.upload_grid_scene(triangles_pre,
+                                                      textures_pre, grid=grid)
+
+        pygame.font.init()
+        self.font = pygame.font.Font(None, 36)
 
-    def load_resources(self):
+    def make_scene(self):
+        # Only the paths for now.  The textures are loaded once it is known
+        # which of them the map uses.
         textures = {}
-        textures_list = []
         for path, i in zip(resources.textures_paths,
                            range(len(resources.textures_paths))):
-            texture = self.racer.load_double_texture(path)
             name = os.path.basename(path).rsplit('.', 1)[0]
-            textures[name] = (i * 2, texture)
-            textures_list.append(texture)
+            textures[name] = (i * 2, path)
         self.textures = textures
-        self.textures_pre = self.racer.preprocess_textures(textures_list)
 
+        self.resolve_level_path()
+        gamemap = mapper.load_map(self.level_path)
+        return self.make_map_arrays(gamemap), resources.textures_paths
+
+    def resolve_level_path(self):
         if not self.level_path:
             self.level_path = os.path.join(resources.maps_dir, 'start.map')
         elif self.level_path == '-':
             self.level_path = 0
 
-        gamemap = mapper.load_map(self.level_path)
-        triangles, textures_used = self.make_map_triangles(gamemap)
-        name = os.path.basename(path).rsplit('.', 1)[0]
-        self.triangles_pre = self.racer.preprocess_triangles(triangles)
-        # FIXME: Actually use textures_used to reduce space use.
-
-        pygame.font.init()
-        self.font = pygame.font.Font(None, 36)
-
-    def make_map_triangles(self, gamemap):
-        f = 200
-
-        triangles_all = []
-        textures_used = set()
-
-        for pos, cell in gamemap.cells.items():
-            xp, zp = pos
-
-            # Floor and ceiling.
-            square2d = [[xp * f - f // 2, zp * f - f // 2],
-                        [xp * f + f // 2, zp * f + f // 2]]
-            triangles2d = square2d_to_triangles2d(square2d)
-            for y, texture in ((0, cell.floor), (cell.height, cell.ceiling)):
+    def compile_triangles(self, triangles, texture_paths):
+        # Returns the preprocessed triangles and the paths of the double
+        # textures they use, in the order of their texture indices.
+        # Plain NumPy, so that maps can be compiled without a Futhark library.
+        triangles_pre = self.racer_module.preprocess_triangles_arrays(*triangles)
+        triangles_pre, used = self.racer_module.compact_textures(triangles_pre)
+        return triangles_pre, [texture_paths[i] for i in used]
+
+    def load_textures(self, texture_paths):
+        textures = [self.racer.load_double_texture_rgb8(path)
+                    for path in texture_paths]
+        return self.racer.preprocess_textures(textures)
+
+    def preprocess_scene(self, triangles, texture_paths):
+        triangles_pre, texture_paths = self.compile_triangles(triangles,
+                                                              texture_paths)
+        return triangles_pre, self.load_textures(texture_paths)
+
+    def compile_map(self):
+        # The preprocessed triangles sorted along with their spatial grid, and
+        # the texture paths.
+        triangles_pre, texture_paths = self.compile_triangles(*self.make_scene())
+        triangles_pre, grid = self.racer_module.build_spatial_grid(
+            triangles_pre, self.grid_cell_size, self.grid_origo,
+            self.grid_block)
+        return triangles_pre, texture_paths, grid
+
+    def load_compiled_map(self):
+        # Building, preprocessing and sorting the triangles of a large map is
+        # slow, so keep the result around for the next launch.  Returns the
+        # preprocessed triangles, the texture paths and the grid, and whether
+        # they came from the cache.  Maps from standard input are always
+        # compiled.
+        self.resolve_level_path()
+        if self.level_path == 0:
+            return self.compile_map(), False
+        key = compiled.compiled_map_key(self.level_path,
+                                        resources.textures_paths,
+                                        self.map_cell_size,
+                                        self.grid_cell_size, self.grid_origo,
+                                        self.grid_block)
+        path = compiled.compiled_map_path(self.racer_module.cache_dir(), key)
+        loaded = compiled.load_compiled_map(path)
+        if loaded is not None:
+            triangles_pre, texture_paths, grid_args = loaded
+            grid = self.racer_module.SpatialGrid(**grid_args)
+            return (triangles_pre, texture_paths, grid), True
+
+        triangles_pre, texture_paths, grid = self.compile_map()
+        try:
+            compiled.save_compiled_map(path, triangles_pre, texture_paths,
+                                       grid, os.path.abspath(self.level_path))
+        except OSError:
+            pass # Not being able to cache is fine.
+        return (triangles_pre, texture_paths, grid), False
+
+    def map_surfaces(self, textures):
+        # The surfaces of the two triangles of each square, for a list of map
+        # textures.  Maps only use a few different textures, so look them up in
+        # a table.
+        keys = {}
+        table = []
+        ids = numpy.empty(len(textures), dtype='int64')
+        for k, texture in enumerate(textures):
+            if isinstance(texture, tuple):
+                key = (texture[0], tuple(texture[1]))
+            else:
+                key = texture
+            if key not in keys:
+                keys[key] = len(table)
                 if isinstance(texture, tuple):
                     assert texture[0] == 'hsv'
-                    hsv = texture[1]
-                    texfun = lambda _: [1, hsv, 0]
-                    i_base = 0 # Doesn't matter.
+                    table.append([(1, texture[1], 0), (1, texture[1], 0)])
                 else:
                     i_base, _ = self.textures[texture]
-                    textures_used.add(texture)
-                    texfun = lambda i: [2, [0, 0, 0], i]
-                triangles = [[[x, (0 - y) * f, z]
-                              for x, z in t] + [texfun(i)]
-                             for t, i in zip(triangles2d, (i_base, i_base + 1))]
-                triangles_all.extend(triangles)
-
-            # Walls.
-            direcs = [(cell.walls.north, [[xp * f - f // 2, -1], [xp * f + f // 2, 0]],
-                       zp * f - f // 2, lambda p, n: [p[0], p[1], n]),
-                      (cell.walls.east, [[zp * f - f // 2, -1], [zp * f + f // 2, 0]],
-                       xp * f + f // 2, lambda p, n: [n, p[1], p[0]]),
-                      (cell.walls.south, [[xp * f - f // 2, -1], [xp * f + f // 2, 0]],
-                       zp * f + f // 2, lambda p, n: [p[0], p[1], n]),
-                      (cell.walls.west,  [[zp * f - f // 2, -1], [zp * f + f // 2, 0]],
-                       xp * f - f // 2, lambda p, n: [n, p[1], p[0]])]
-            for textures, square2d, n, fun in direcs:
-                triangles2d = square2d_to_triangles2d(square2d)
-                for y_offset, texture in textures:
-                    if isinstance(texture, tuple):
-                        assert texture[0] == 'hsv'
-                        hsv = texture[1]
-                        texfun = lambda _: [1, hsv, 0]
-                        i_base = 0 # Doesn't matter.
-                    else:
-                        i_base, _ = self.textures[texture]
-                        textures_used.add(texture)
-                        texfun = lambda i: [2, [0, 0, 0], i]
-                    triangles = [[(lambda x, y, z:
-                                   [x, (y - y_offset) * f, z])(*fun(p, n))
-                                  for p in t] + [texfun(i)]
-                                 for t, i in zip(triangles2d, (i_base, i_base + 1))]
-                    triangles_all.extend(triangles)
-
-        return triangles_all, textures_used
+                    table.append([(2, (0, 0, 0), i_base),
+                                  (2, (0, 0, 0), i_base + 1)])
+            ids[k] = keys[key]
+        table = numpy.array(table, dtype=self.racer_module.surface_dtype)
+        return table.reshape(-1, 2)[ids]
+
+    def make_map_arrays(self, gamemap):
+        # Build the triangles of all squares of one kind at a time: all floors,
+        # all ceilings, and all walls facing each direction.  Returns an
+        # (n, 3, 3) array of vertices and an array of n surfaces.
+        f = self.map_cell_size
+        h = f // 2
+
+        positions = numpy.array(list(gamemap.cells.keys()),
+                                dtype='float32').reshape(-1, 2)
+        cells = list(gamemap.cells.values())
+        xs = positions[:, 0] * f
+        zs = positions[:, 1] * f
+        heights = numpy.array([cell.height for cell in cells], dtype='float32')
+
+        verticess = []
+        surfacess = []
+        def add_squares(a_lu, b_lu, a_rl, b_rl, to_3d, textures):
+            # Split every square into two triangles that share the left upper
+            # and right lower corners.  The first one shows the first texture
+            # of a double texture, and the second one the other.  a and b are
+            # the 2D coordinates of the points as (n, 2, 3) arrays.
+            a = numpy.stack([numpy.stack([a_lu, a_lu, a_rl], axis=1),
+                             numpy.stack([a_rl, a_rl, a_lu], axis=1)], axis=1)
+            b = numpy.stack([numpy.stack([b_lu, b_rl, b_lu], axis=1),
+                             numpy.stack([b_rl, b_lu, b_rl], axis=1)], axis=1)
+            verticess.append(numpy.stack(numpy.broadcast_arrays(*to_3d(a, b)),
+                                         axis=-1).reshape(-1, 3, 3))
+            surfacess.append(self.map_surfaces(textures).reshape(-1))
+
+        def column(xs):
+            return numpy.reshape(xs, (-1, 1, 1))
+
+        # Floors and ceilings.  Triangles are only seen from the side where
+        # their vertices are counter-clockwise on the screen, so the floors are
+        # mirrored to face up.
+        add_squares(xs + h, zs - h, xs - h, zs + h,
+                    lambda a, b: (a, 0.0, b),
+                    [cell.floor for cell in cells])
+        add_squares(xs - h, zs - h, xs + h, zs + h,
+                    lambda a, b: (a, column(-heights * f), b),
+                    [cell.ceiling for cell in cells])
+
+        # Walls, all facing into the cell.  A wall has one square per y offset.
+        for direc in ['north', 'east', 'south', 'west']:
+            walls = [(x, z, y_offset, texture)
+                     for (x, z), cell in gamemap.cells.items()
+                     for y_offset, texture in getattr(cell.walls, direc)]
+            if not walls:
+                continue
+            wall_xs = numpy.array([w[0] for w in walls], dtype='float32') * f
+            wall_zs = numpy.array([w[1] for w in walls], dtype='float32') * f
+            y_offsets = column(numpy.array([w[2] for w in walls],
+                                           dtype='float32'))
+            textures = [w[3] for w in walls]
+            tops = numpy.full(len(walls), -1.0, dtype='float32')
+            bottoms = numpy.zeros(len(walls), dtype='float32')
+            if direc == 'north':
+                add_squares(wall_xs + h, tops, wall_xs - h, bottoms,
+                            lambda a, b: (a, (b - y_offsets) * f,
+                                          column(wall_zs - h)),
+                            textures)
+            elif direc == 'east':
+                add_squares(wall_zs + h, tops, wall_zs - h, bottoms,
+                            lambda a, b: (column(wall_xs + h),
+                                          (b - y_offsets) * f, a),
+                            textures)
+            elif direc == 'south':
+                add_squares(wall_xs - h, tops, wall_xs + h, bottoms,
+                            lambda a, b: (a, (b - y_offsets) * f,
+                                          column(wall_zs + h)),
+                            textures)
+            else:
+                add_squares(wall_zs - h, tops, wall_zs + h, bottoms,
+                            lambda a, b: (column(wall_xs - h),
+                                          (b - y_offsets) * f, a),
+                            textures)
+
+        vertices = numpy.concatenate(verticess).astype('float32')
+        surfaces = numpy.concatenate(surfacess)
+        return vertices, surfaces
 
     def setup_screen(self):
         # Check related input.
@@ -135,8 +280,6 @@ class Doom:
         pygame.display.set_caption('futdoom')
         screen_size = self.scale_to if self.scale_to else self.size
         self.screen = pygame.display.set_mode(screen_size)
-        if self.scale_to:
-            self.surface_base = pygame.Surface(self.size, depth=32)
         self.surface = pygame.Surface(screen_size, depth=32)
         self.clock = pygame.time.Clock()
 
@@ -145,7 +288,14 @@ class Doom:
         self.screen.blit(text, where)
 
     def loop(self):
-        camera = [[700.0, -180.0, 700.0], [0.0, 0.0, 0.0]]
+        pipeline = self.racer_module.FramePipeline(self.racer, self.pipeline)
+        try:
+            return self.run_frames(pipeline)
+        finally:
+            pipeline.close()
+
+    def run_frames(self, pipeline):
+        camera = [list(self.camera_start[0]), list(self.camera_start[1])]
 
         keys_holding = {}
         for x in [pygame.K_UP, pygame.K_DOWN, pygame.K_LEFT, pygame.K_RIGHT,
@@ -158,37 +308,63 @@ class Doom:
                 yield i
                 i += 1
 
+        planner = self.racer_module.FramePlanner(self.racer)
+        if self.frame_budget is not None:
+            budget = self.racer_module.FrameBudget(
+                self.frame_budget, min_render_scale=self.min_render_scale)
+
         for i in inf_range():
             fps = self.clock.get_fps()
-            time_start = time.time()
-
-            frame = self.racer.render_triangles_preprocessed(
-                self.size, self.view_dist, self.draw_dist, camera,
-                self.triangles_pre, self.textures_pre, self.render_approach)
-            frame = frame.get()
-            if not self.scale_to:
-                pygame.surfarray.blit_array(self.surface, frame)
-            else:
-                pygame.surfarray.blit_array(self.surface_base, frame)
-                pygame.transform.scale(self.surface_base, self.scale_to, self.surface)
-            self.screen.blit(self.surface, (0, 0))
-            time_end = time.time()
-            futhark_dur_ms = (time_end - time_start) * 1000
-
-            if self.auto_fps:
-                if futhark_dur_ms > 20:
-                    self.draw_dist /= 1.1
-                else:
-                    self.draw_dist += 10.0
 
-            self.message('FPS: {:.02f}'.format(fps), (10, 10))
-            self.message('Futhark: {:.02f} ms'.format(futhark_dur_ms), (10, 40))
-            self.message('Draw distance: {:.02f}{}'.format(
-                self.draw_dist, ' (auto)' if self.auto_fps else ''), (10, 70))
-            self.message('Rendering approach: {}'.format(self.render_approach), (10, 100))
-            if self.render_approach == 'chunked':
-                self.message('# draw rects: x: {}, y: {}'.format(
-                    *self.n_draw_rects), (10, 130))
+            camera_now = (tuple(camera[0]), tuple(camera[1]))
+            if self.streamer is not None:
+                self.scene = self.streamer.update(camera_now, self.size,
+                                                  self.view_dist,
+                                                  self.draw_dist)
+            render_approach, n_draw_rects, ranges, tag = planner.plan(
+                self.size, self.view_dist, self.draw_dist, camera_now,
+                self.scene, self.render_approach, self.n_draw_rects)
+            self.n_draw_rects = list(n_draw_rects)
+
+            frame = pipeline.push(functools.partial(
+                self.racer.render_scene,
+                self.size, self.view_dist, self.draw_dist, camera_now,
+                self.scene, render_approach, n_draw_rects, ranges,
+                self.render_scale), tag)
+            if frame is not None:
+                self.frame_surface = self.racer_module.present_frame(
+                    self.surface, frame, self.frame_surface)
+                self.screen.blit(self.surface, (0, 0))
+                # Only count rendering and reading back, in both modes, so that
+                # showing the frame does not eat into the budget.
+                futhark_dur_ms = pipeline.render_ms + pipeline.get_ms
+                planner.report(pipeline.tag, futhark_dur_ms)
+
+                if self.frame_budget is not None:
+                    self.draw_dist, self.render_scale = budget.update(
+                        futhark_dur_ms, self.draw_dist, self.render_scale)
+
+                self.message('FPS: {:.02f}'.format(fps), (10, 10))
+                self.message('Futhark: {:.02f} ms'.format(futhark_dur_ms), (10, 40))
+                self.message('Draw distance: {:.02f}{}'.format(
+                    self.draw_dist,
+                    ' (auto)' if self.frame_budget is not None else ''), (10, 70))
+                self.message('Rendering approach: {}'.format(self.render_approach), (10, 100))
+                self.message('Render scale: {:.02f}{}'.format(
+                    self.render_scale,
+                    ' (auto)' if self.min_render_scale is not None else ''), (10, 190))
+                if self.streamer is not None:
+                    self.message('Streaming: {} chunks, {} triangles'.format(
+                        len(self.streamer.loaded),
+                        self.streamer.n_triangles), (10, 220))
+                if planner.predicted_ms is not None:
+                    self.message('Chosen: {} (predicted: {:.02f} ms, actual: {:.02f} ms)'.format(
+                        planner.render_approach, planner.predicted_ms,
+                        planner.actual_ms), (10, 130))
+                if planner.render_approach == 'chunked':
+                    self.message('# draw rects: x: {}, y: {}{}'.format(
+                        *self.n_draw_rects,
+                        ' (auto)' if planner.tune_draw_rects else ''), (10, 160))
 
             pygame.display.flip()
 
@@ -208,13 +384,21 @@ class Doom:
                             self.racer_module.render_approaches,
                             self.render_approach)
 
+                    if event.key == pygame.K_3:
+                        self.render_scale = max(0.25, self.render_scale - 0.05)
+                    if event.key == pygame.K_4:
+                        self.render_scale = min(1.0, self.render_scale + 0.05)
                     if event.key == pygame.K_a:
+                        planner.tune_draw_rects = False
                         self.n_draw_rects[0] = max(1, self.n_draw_rects[0] - 1)
                     if event.key == pygame.K_d:
+                        planner.tune_draw_rects = False
                         self.n_draw_rects[0] = self.n_draw_rects[0] + 1
                     if event.key == pygame.K_w:
+                        planner.tune_draw_rects = False
                         self.n_draw_rects[1] = max(1, self.n_draw_rects[1] - 1)
                     if event.key == pygame.K_s:
+                        planner.tune_draw_rects = False
                         self.n_draw_rects[1] = self.n_draw_rects[1] + 1
 
                 elif event.type == pygame.KEYUP:
@@ -0,0 +1,161 @@
+import threading
+import collections
+
+import numpy
+
+class ChunkStreamer:
+    # Streams a large map in chunks.  The chunks are the blocks of the spatial
+    # grid of the map, whose triangles are already sorted by block and, within
+    # a block, by grid cell.  Only the chunks within draw distance of the
+    # camera are in the scene: whenever the set of chunks changes, a
+    # background thread uploads the chunks that are new to it and joins them
+    # with the chunks it keeps from the previous scene in the Futhark context,
+    # so a chunk is only transferred when it comes into reach.  The grid of the
+    # new scene is the map's grid restricted to its chunks, so nothing is
+    # sorted.  While this goes on, the previous scene is still rendered.
+    #
+    # The triangles of recently used chunks are copied out of the map and
+    # kept in memory, and evicted least recently used first.  Every copy of
+    # the triangles counts against the budget: the kept chunks, the new chunks
+    # both joined for the upload and uploaded, and both the old and the new
+    # scene in the Futhark context.  If the chunks within draw distance do not
+    # fit, the farthest ones are left out.
+    def __init__(self, racer, triangles_pre, textures_pre, grid, budget):
+        self.racer = racer
+        self.triangles_pre = triangles_pre
+        self.textures_dev = racer.upload_textures(textures_pre)
+        self.grid = grid
+        self.triangle_bytes = sum(xs.dtype.itemsize for xs in triangles_pre)
+        self.budget = budget // self.triangle_bytes
+
+        self.starts = grid.block_starts()
+        self.counts = numpy.diff(self.starts)
+
+        # The bounding rectangles of the chunks in the x/z plane.
+        n_cells = grid.block * grid.block
+        used = grid.cell_used.reshape(-1, n_cells)
+        xzs = [0, 2]
+        mins = grid.cell_mins[:, xzs].reshape(-1, n_cells, 2)
+        maxs = grid.cell_maxs[:, xzs].reshape(-1, n_cells, 2)
+        self.mins = numpy.where(used[:, :, None], mins, numpy.inf).min(axis=1)
+        self.maxs = numpy.where(used[:, :, None], maxs, -numpy.inf).max(axis=1)
+
+        self.cache = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.requested = None
+        self.loaded = None
+        self.scene = None
+        self.n_triangles = 0
+        self.stopped = False
+        self.thread = None
+
+    def reach(self, size, view_dist, draw_dist):
+        # draw_dist limits the depth of a point, not its distance, so points
+        # to the side can be farther away.  This is the farthest a point in
+        # view can be in the x/z plane, whichever way the camera turns (it
+        # never tilts up or down).  See SpatialGrid.visible_cells.
+        w, _ = size
+        k = (w / 2 + 1) / view_dist
+        return float(numpy.hypot(draw_dist, k * (draw_dist + view_dist)))
+
+    def wanted_chunks(self, position, size, view_dist, draw_dist):
+        x, _, z = position
+        reach = self.reach(size, view_dist, draw_dist)
+        dx = numpy.maximum(numpy.maximum(self.mins[:, 0] - x,
+                                         x - self.maxs[:, 0]), 0)
+        dz = numpy.maximum(numpy.maximum(self.mins[:, 1] - z,
+                                         z - self.maxs[:, 1]), 0)
+        dists = numpy.hypot(dx, dz)
+        near = numpy.flatnonzero((self.counts > 0) & (dists <= reach))
+        near = near[numpy.argsort(dists[near], kind='stable')]
+        # The chunks in view are in memory up to five times: in the cache,
+        # joined for the upload and uploaded, and in the old and the new scene.
+        n_fit = numpy.searchsorted(numpy.cumsum(self.counts[near]),
+                                   self.budget // 5, side='right')
+        return tuple(sorted(near[:n_fit].tolist()))
+
+    def start(self, camera, size, view_dist, draw_dist):
+        # Load the first chunks before returning, so that there is something
+        # to render from the start.
+        wanted = self.wanted_chunks(camera[0], size, view_dist, draw_dist)
+        self.scene = self.load(wanted)
+        self.requested = self.loaded = wanted
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.scene
+
+    def update(self, camera, size, view_dist, draw_dist):
+        # Returns the newest scene.  It may not have caught up with camera yet.
+        wanted = self.wanted_chunks(camera[0], size, view_dist, draw_dist)
+        with self.condition:
+            if wanted != self.requested:
+                self.requested = wanted
+                self.condition.notify()
+            return self.scene
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.requested == self.loaded and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                wanted = self.requested
+            scene = self.load(wanted)
+            with self.condition:
+                self.scene = scene
+                self.loaded = wanted
+
+    def read_chunk(self, chunk):
+        start, end = self.starts[chunk], self.starts[chunk + 1]
+        return tuple(numpy.array(xs[start:end]) for xs in self.triangles_pre)
+
+    def evict(self, wanted, n_wanted):
+        # Leave room for the new chunks and the two scenes.
+        n_cached = sum(len(triangles[0]) for triangles in self.cache.values())
+        for chunk in list(self.cache.keys()):
+            if n_cached <= self.budget - 4 * n_wanted:
+                break
+            if chunk not in wanted:
+                n_cached -= len(self.cache.pop(chunk)[0])
+
+    def load(self, wanted):
+        # Only the chunks that are not in the current scene are uploaded.
+        loaded = self.loaded if self.loaded is not None else ()
+        loaded_set = set(loaded)
+        new = [chunk for chunk in wanted if chunk not in loaded_set]
+        for chunk in wanted:
+            if chunk in self.cache:
+                self.cache.move_to_end(chunk)
+            elif chunk in new:
+                self.cache[chunk] = self.read_chunk(chunk)
+        n_wanted = int(self.counts[list(wanted)].sum())
+        self.evict(set(wanted), n_wanted)
+
+        # Where every chunk starts in the triangles of the current scene
+        # followed by the new chunks.
+        offsets = {}
+        offset = 0
+        for chunk in list(loaded) + new:
+            offsets[chunk] = offset
+            offset += int(self.counts[chunk])
+        starts = [offsets[chunk] for chunk in wanted]
+
+        if len(new) > 0:
+            triangles_pre = tuple(
+                numpy.concatenate(xss)
+                for xss in zip(*(self.cache[chunk] for chunk in new)))
+        else:
+            triangles_pre = tuple(xs[:0] for xs in self.triangles_pre)
+        grid = self.grid.select_blocks(numpy.array(wanted, dtype='int64'))
+        self.n_triangles = n_wanted
+        return self.racer.join_grid_scene(self.scene, triangles_pre, starts,
+                                          self.counts[list(wanted)], grid,
+                                          self.textures_dev)
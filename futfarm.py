@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import random
+import argparse
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+
+# Never open a window.
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import numpy
+
+import futracer
+import futcubes
+import futfly
+import futdoomlib.runner
+
+
+def make_cubes(size, render_approach):
+    return futcubes.FutCubes(size=size, render_approach=render_approach)
+
+def make_fly(size, render_approach):
+    return futfly.FutFly(size=size, render_approach=render_approach)
+
+def make_doom(size, render_approach):
+    doom = futdoomlib.runner.Doom(futracer, level_path=None,
+                                  render_approach=render_approach)
+    if size is not None:
+        doom.size = size
+    return doom
+
+apps = {
+    'futcubes': make_cubes,
+    'futfly': make_fly,
+    'futdoom': make_doom,
+}
+
+def share_arrays(arrays):
+    # Copy arrays into one block of shared memory.  Returns the block and the
+    # (offset, dtype, shape) of every array in it.
+    layout = []
+    offset = 0
+    for xs in arrays:
+        offset = (offset + 63) // 64 * 64
+        layout.append((offset, xs.dtype.str, xs.shape))
+        offset += xs.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(1, offset))
+    for xs, (offset, dtype, shape) in zip(arrays, layout):
+        numpy.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = xs
+    return shm, layout
+
+def attach_arrays(name, layout):
+    # Workers share the resource tracker of the farm, so attaching does not
+    # make them remove the block when they exit.
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = [numpy.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+              for offset, dtype, shape in layout]
+    return shm, arrays
+
+# The state of a worker process.
+worker = None
+
+class Worker:
+    def __init__(self, app_name, size, render_approach, backend, shm_name,
+                 layout, textures_size, grid, path, n_frames, record_format,
+                 cameras):
+        self.shm, arrays = attach_arrays(shm_name, layout)
+        triangles_pre = tuple(arrays[:-1])
+        textures_pre = tuple(textures_size) + (arrays[-1],)
+
+        self.app = apps[app_name](size, render_approach)
+        self.racer = futracer.FutRacer(backend)
+        self.app.racer = self.racer
+        # The triangles are already sorted along with grid, so they are
+        # uploaded straight from the shared memory.
+        self.scene = self.racer.upload_grid_scene(triangles_pre, textures_pre,
+                                                  grid=grid)
+        self.update_scene = getattr(self.app, 'update_scene', None)
+        self.planner = futracer.FramePlanner(self.racer)
+        self.frame_size = futracer.scaled_size(self.app.size,
+                                               self.app.render_scale)
+        self.output = futracer.FrameFile(path, self.frame_size, n_frames,
+                                         record_format, create=False)
+        self.cameras = cameras
+        self.buffer = numpy.empty(self.frame_size, dtype='uint32')
+
+    def render_frames(self, frames):
+        app = self.app
+        for i in frames:
+            time_start = time.time()
+            if self.update_scene is not None:
+                self.update_scene(self.scene, i)
+            approach, n_draw_rects, ranges, tag = self.planner.plan(
+                app.size, app.view_dist, app.draw_dist, self.cameras[i],
+                self.scene, app.render_approach, app.n_draw_rects,
+                app.render_scale)
+            frame = self.racer.render_scene(
+                app.size, app.view_dist, app.draw_dist, self.cameras[i],
+                self.scene, approach, n_draw_rects, ranges, app.render_scale)
+            self.racer.from_device(frame, out=self.buffer)
+            self.planner.report(tag, (time.time() - time_start) * 1000)
+            self.output.write(i, self.buffer)
+        self.output.flush()
+        return frames
+
+def init_worker(*args):
+    global worker
+    worker = Worker(*args)
+
+def render_frames(frames):
+    return worker.render_frames(frames)
+
+class Farm:
+    # Splits the frames of a camera path into small batches and renders them in
+    # a pool of worker processes.  The preprocessed scene is sorted into its
+    # spatial grid once and handed to the workers in shared memory, along with
+    # the grid, and every worker uploads it to its own futracerlib instance.
+    # Workers write their frames straight to their places in the output, and
+    # the batches are collected in order.
+    def __init__(self, app_name, size, render_approach, backend, n_workers,
+                 batch_size, seed):
+        self.app_name = app_name
+        self.size = size
+        self.render_approach = render_approach
+        self.backend = backend
+        self.n_workers = n_workers
+        self.batch_size = batch_size
+        self.seed = seed
+
+    def run(self, path, n_frames, camera_path, record_format):
+        app = apps[self.app_name](self.size, self.render_approach)
+        app.racer = futracer.FutRacer(self.backend)
+        random.seed(self.seed)
+        triangles_pre, textures_pre = app.preprocess_scene(*app.make_scene())
+        triangles_pre, grid = futracer.build_spatial_grid(
+            triangles_pre, app.grid_cell_size, app.grid_origo)
+        cameras = futracer.recording_cameras(camera_path, n_frames,
+                                             app.camera_start)
+        frame_size = futracer.scaled_size(app.size, app.render_scale)
+        # Create the output before the workers open it.
+        futracer.FrameFile(path, frame_size, len(cameras), record_format)
+
+        shm, layout = share_arrays(list(triangles_pre) + [textures_pre[3]])
+        try:
+            batches = [range(i, min(i + self.batch_size, len(cameras)))
+                       for i in range(0, len(cameras), self.batch_size)]
+            # Futhark contexts do not survive a fork, so start afresh.
+            context = multiprocessing.get_context('spawn')
+            with context.Pool(
+                    self.n_workers, initializer=init_worker,
+                    initargs=(self.app_name, self.size, self.render_approach,
+                              app.racer.backend, shm.name, layout, textures_pre[:3], grid,
+                              path, len(cameras), record_format, cameras)) as pool:
+                time_start = time.time()
+                time_logged = time_start
+                n_done = 0
+                for frames in pool.imap(render_frames, batches):
+                    n_done += len(frames)
+                    time_now = time.time()
+                    if time_now - time_logged >= 1.0:
+                        print('Rendered {} of {} frames ({:.02f} frames/s)'.format(
+                            n_done, len(cameras),
+                            n_done / (time_now - time_start)), file=sys.stderr)
+                        time_logged = time_now
+                time_total = time.time() - time_start
+        finally:
+            shm.close()
+            shm.unlink()
+
+        print('Rendered {} frames of {}x{} to {} with {} {} workers in {:.02f} s ({:.02f} frames/s)'.format(
+            len(cameras), frame_size[0], frame_size[1], path, self.n_workers,
+            app.racer.backend, time_total, len(cameras) / max(time_total, 1e-9)), file=sys.stderr)
+
+def main(args):
+    def size(s):
+        return tuple(map(int, s.split('x')))
+
+    arg_parser = argparse.ArgumentParser(description='Render a camera path of one of the example programs in several processes at once, without opening a window.')
+    arg_parser.add_argument('app', choices=list(apps.keys()),
+                            help='the program whose scene to render')
+    arg_parser.add_argument('path',
+                            help='write the frames to this file (or directory with --record-format png)')
+    arg_parser.add_argument('--record-format', choices=['raw', 'png'],
+                            default='raw',
+                            help='write one file of RGB24 frames, or a directory of PNG files (defaults to raw)')
+    arg_parser.add_argument('--frames', type=futracer.positive, metavar='N',
+                            help='the number of frames to render (defaults to the length of the camera path, or 360)')
+    arg_parser.add_argument('--camera-path', metavar='FILE',
+                            help='render along the cameras in FILE, one "x y z angle_x angle_y angle_z" per line (defaults to turning around once)')
+    arg_parser.add_argument('--size', type=size, metavar='WIDTHxHEIGHT',
+                            help='the size of the frames')
+    arg_parser.add_argument('--render-approach',
+                            choices=futracer.render_approaches,
+                            default='segmented',
+                            help='choose how to render a frame')
+    arg_parser.add_argument('--backend',
+                            choices=['auto'] + futracer.futhark_backends,
+                            help='the Futhark backend the workers render with (defaults to $FUTRACER_BACKEND, or the first one that works; c scales best)')
+    arg_parser.add_argument('--workers', type=futracer.positive,
+                            default=os.cpu_count(),
+                            help='the number of worker processes (defaults to the number of cores)')
+    arg_parser.add_argument('--batch-size', type=futracer.positive, default=8,
+                            help='the number of frames a worker renders at a time (defaults to 8)')
+    arg_parser.add_argument('--seed', type=int, default=0,
+                            help='the random seed for building the scene (defaults to 0)')
+
+    args = arg_parser.parse_args(args)
+
+    farm = Farm(args.app, args.size, args.render_approach, args.backend,
+                args.workers, args.batch_size, args.seed)
+    farm.run(args.path, args.frames, args.camera_path, args.record_format)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -5,7 +5,6 @@ import os.path
 import math
 import random
 import argparse
-import time
 import itertools
 import functools
 
@@ -15,7 +14,9 @@ import futracer
 
 
 class FutFly:
-    def __init__(self, size=None, render_approach=None):
+    def __init__(self, size=None, render_approach=None, pipeline=False,
+                 frame_budget=None, render_scale=1.0, min_render_scale=None,
+                 backend=None):
         if size is None:
             size = (800, 600)
         self.size = size
@@ -24,9 +25,18 @@ class FutFly:
         self.render_approach = render_approach
         self.view_dist = 600.0
         self.draw_dist = 20000.0
-        if render_approach != 'segmented':
+        if render_approach in ('chunked', 'scatter_bbox'):
             self.draw_dist /= 10 # The others are really that much slower.
         self.n_draw_rects = [1, 1]
+        self.grid_cell_size = 1500.0
+        self.grid_origo = None
+        self.camera_start = ((15000.0, -500.0, 0.0), (0.0, 0.0, 0.0))
+        self.pipeline = pipeline
+        self.frame_budget = frame_budget
+        self.render_scale = render_scale
+        self.min_render_scale = min_render_scale
+        self.backend = backend
+        self.frame_surface = None
 
     def fly(self):
         # Setup pygame.
@@ -38,11 +48,23 @@ class FutFly:
         self.clock = pygame.time.Clock()
 
         # Load the library.
-        self.racer = futracer.FutRacer()
+        self.racer = futracer.FutRacer(self.backend)
 
         # Actually run!
         return self.loop()
 
+    def record(self, path, n_frames=None, camera_path=None,
+               record_format='raw'):
+        self.racer = futracer.FutRacer(self.backend)
+        scene = self.upload()
+        cameras = futracer.recording_cameras(camera_path, n_frames,
+                                             self.camera_start)
+        futracer.record_frames(self.racer, scene, self.size, self.view_dist,
+                               self.draw_dist, cameras, path, record_format,
+                               self.render_approach, self.n_draw_rects,
+                               self.render_scale)
+        return 0
+
     def message(self, what, where):
         text = self.font.render(what, 1, (255, 255, 255))
         self.screen.blit(text, where)
@@ -93,7 +115,8 @@ class FutFly:
                     hsv = [random.random() * 360.0,
                            random.random() * 0.5 + 0.5,
                            random.random() * 0.5 + 0.5]
-                    surface = [1, hsv, -1]
+                    # The terrain can be seen from below.
+                    surface = [1 | futracer.surface_double_sided, hsv, -1]
                     triangle = [p0, p1, p2, surface]
                     triangle_row.append(triangle)
             triangle_rows.append(triangle_row)
@@ -124,15 +147,40 @@ class FutFly:
         triangles = list(itertools.chain(*triangle_rows))
         return triangles, []
 
-    def loop(self):
-        triangles, textures = self.terrain()
+    def make_scene(self):
+        return self.terrain()
+
+    def preprocess_scene(self, triangles, textures):
+        return (self.racer.preprocess_triangles(triangles),
+                self.racer.preprocess_textures(textures))
+
+    def upload(self):
+        triangles, textures = self.make_scene()
 
         # The objects will not change (only the camera changes), so we
         # preprocess them to save important loop time.
-        triangles_pre = self.racer.preprocess_triangles(triangles)
-        textures_pre = self.racer.preprocess_textures(textures)
+        triangles_pre, textures_pre = self.preprocess_scene(triangles, textures)
+        # They also stay in the Futhark context between frames.
+        return self.racer.upload_grid_scene(triangles_pre, textures_pre,
+                                            self.grid_cell_size,
+                                            self.grid_origo)
+
+    def loop(self):
+        scene = self.upload()
+
+        pipeline = futracer.FramePipeline(self.racer, self.pipeline)
+        try:
+            return self.run_frames(scene, pipeline)
+        finally:
+            pipeline.close()
+
+    def run_frames(self, scene, pipeline):
+        planner = futracer.FramePlanner(self.racer)
+        if self.frame_budget is not None:
+            budget = futracer.FrameBudget(
+                self.frame_budget, min_render_scale=self.min_render_scale)
 
-        camera = [[15000.0, -500.0, 0.0], [0.0, 0.0, 0.0]]
+        camera = [list(self.camera_start[0]), list(self.camera_start[1])]
 
         keys_holding = {}
         for x in [pygame.K_UP, pygame.K_DOWN, pygame.K_LEFT, pygame.K_RIGHT,
@@ -148,28 +196,46 @@ class FutFly:
         for i in inf_range():
             fps = self.clock.get_fps()
 
-            time_start = time.time()
-            frame = self.racer.render_triangles(
-                self.size, self.view_dist, self.draw_dist, camera,
-                None, triangles_pre,
-                None, textures_pre, self.render_approach, self.n_draw_rects)
-            time_end = time.time()
-            time_start_get = time.time()
-            frame = frame.get()
-            time_end_get = time.time()
-
-            futhark_dur_ms = (time_end - time_start) * 1000
-            futhark_get_ms = (time_end_get - time_start_get) * 1000
-            pygame.surfarray.blit_array(self.surface, frame)
-            self.screen.blit(self.surface, (0, 0))
-
-            self.message('FPS: {:.02f}'.format(fps), (10, 10))
-            self.message('Futhark: {:.02f} ms (memory get: {:.02f} ms)'.format(futhark_dur_ms, futhark_get_ms), (10, 40))
-            self.message('Draw distance: {:.02f}'.format(self.draw_dist), (10, 70))
-            self.message('Rendering approach: {}'.format(self.render_approach), (10, 100))
-            if self.render_approach == 'chunked':
-                self.message('# draw rects: x: {}, y: {}'.format(
-                    *self.n_draw_rects), (10, 130))
+            camera_now = (tuple(camera[0]), tuple(camera[1]))
+            render_approach, n_draw_rects, ranges, tag = planner.plan(
+                self.size, self.view_dist, self.draw_dist, camera_now, scene,
+                self.render_approach, self.n_draw_rects, self.render_scale)
+            self.n_draw_rects = list(n_draw_rects)
+
+            frame = pipeline.push(functools.partial(
+                self.racer.render_scene,
+                self.size, self.view_dist, self.draw_dist, camera_now,
+                scene, render_approach, n_draw_rects, ranges,
+                self.render_scale), tag)
+            if frame is not None:
+                futhark_dur_ms = pipeline.render_ms
+                futhark_get_ms = pipeline.get_ms
+                planner.report(pipeline.tag, futhark_dur_ms + futhark_get_ms)
+                if self.frame_budget is not None:
+                    self.draw_dist, self.render_scale = budget.update(
+                        futhark_dur_ms + futhark_get_ms, self.draw_dist,
+                        self.render_scale)
+                self.frame_surface = futracer.present_frame(
+                    self.surface, frame, self.frame_surface)
+                self.screen.blit(self.surface, (0, 0))
+
+                self.message('FPS: {:.02f}'.format(fps), (10, 10))
+                self.message('Futhark: {:.02f} ms (memory get: {:.02f} ms)'.format(futhark_dur_ms, futhark_get_ms), (10, 40))
+                self.message('Draw distance: {:.02f}{}'.format(
+                    self.draw_dist,
+                    ' (auto)' if self.frame_budget is not None else ''), (10, 70))
+                self.message('Rendering approach: {}'.format(self.render_approach), (10, 100))
+                self.message('Render scale: {:.02f}{}'.format(
+                    self.render_scale,
+                    ' (auto)' if self.min_render_scale is not None else ''), (10, 190))
+                if planner.predicted_ms is not None:
+                    self.message('Chosen: {} (predicted: {:.02f} ms, actual: {:.02f} ms)'.format(
+                        planner.render_approach, planner.predicted_ms,
+                        planner.actual_ms), (10, 130))
+                if planner.render_approach == 'chunked':
+                    self.message('# draw rects: x: {}, y: {}{}'.format(
+                        *self.n_draw_rects,
+                        ' (auto)' if planner.tune_draw_rects else ''), (10, 160))
 
             pygame.display.flip()
 
@@ -187,13 +253,21 @@ class FutFly:
                     if event.key == pygame.K_r:
                         self.render_approach = futracer.next_elem(futracer.render_approaches,
                                                                   self.render_approach)
+                    if event.key == pygame.K_3:
+                        self.render_scale = max(0.25, self.render_scale - 0.05)
+                    if event.key == pygame.K_4:
+                        self.render_scale = min(1.0, self.render_scale + 0.05)
                     if event.key == pygame.K_a:
+                        planner.tune_draw_rects = False
                         self.n_draw_rects[0] = max(1, self.n_draw_rects[0] - 1)
                     if event.key == pygame.K_d:
+                        planner.tune_draw_rects = False
                         self.n_draw_rects[0] = self.n_draw_rects[0] + 1
                     if event.key == pygame.K_w:
+                        planner.tune_draw_rects = False
                         self.n_draw_rects[1] = max(1, self.n_draw_rects[1] - 1)
                     if event.key == pygame.K_s:
+                        planner.tune_draw_rects = False
                         self.n_draw_rects[1] = self.n_draw_rects[1] + 1
 
                 elif event.type == pygame.KEYUP:
@@ -244,10 +318,18 @@ def main(args):
                             choices=futracer.render_approaches,
                             default='segmented',
                             help='choose how to render a frame')
+    futracer.add_app_arguments(arg_parser)
 
     args = arg_parser.parse_args(args)
 
-    fly = FutFly(size=args.size, render_approach=args.render_approach)
+    fly = FutFly(size=args.size, render_approach=args.render_approach,
+                 pipeline=args.pipeline, frame_budget=args.frame_budget,
+                 render_scale=args.render_scale,
+                 min_render_scale=args.min_render_scale,
+                 backend=args.backend)
+    if args.record is not None:
+        return fly.record(args.record, args.frames, args.camera_path,
+                          args.record_format)
     return fly.fly()
 
 if __name__ == '__main__':
@@ -1,27 +1,782 @@
-import itertools
+import os
+import os.path
+import sys
+import time
+import hashlib
 import colorsys
+import threading
+import queue
+import importlib
+import argparse
+import concurrent.futures
 
 import numpy
 import png
-
-import futracerlib
+import pygame
 
 
 render_approaches_map = {
     'segmented': 1,
     'chunked': 2,
     'scatter_bbox': 3,
+    'bvh': 4,
+    'tiled': 5,
 }
-render_approaches = list(render_approaches_map.keys())
+# 'auto' picks one of the others for every frame, see FramePlanner.
+render_approaches = list(render_approaches_map.keys()) + ['auto']
+
+# The array form of the fourth element of a triangle: (surface type, HSV color,
+# texture index).
+surface_dtype = numpy.dtype([
+    ('type', 'int32'),
+    ('hsv', 'float32', (3,)),
+    ('index', 'int32'),
+])
+
+# Set this bit in the surface type to draw a triangle from both sides.  Other
+# triangles are only drawn from the side where their points are
+# counter-clockwise on the screen.
+surface_double_sided = 4
+
+# The Futhark backends futracerlib can be built with, in the order 'auto' tries
+# them.  'opencl' is the futracerlib.py module from futhark pyopencl, while the
+# others are cffi modules built with futhark_ffi (see the Makefile).
+futhark_backends = ['opencl', 'multicore', 'c']
+
+def cache_dir():
+    path = os.environ.get('FUTRACER_CACHE_DIR')
+    if path is None:
+        path = os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                           os.path.expanduser('~/.cache')),
+                            'futracer')
+    return path
+
+def scaled_size(size, render_scale):
+    # The size of the frames rendered for a window of size at render_scale.
+    w, h = size
+    return (max(1, int(round(w * render_scale))),
+            max(1, int(round(h * render_scale))))
+
+def present_frame(surface, frame, frame_surface=None):
+    # Show a frame on surface.  Frames rendered below the window resolution
+    # are scaled up in one go, through frame_surface.  Returns the frame
+    # surface to pass along with the next frame.
+    if frame.shape == surface.get_size():
+        pygame.surfarray.blit_array(surface, frame)
+    else:
+        if frame_surface is None or frame_surface.get_size() != frame.shape:
+            frame_surface = pygame.Surface(frame.shape, depth=32)
+        pygame.surfarray.blit_array(frame_surface, frame)
+        pygame.transform.scale(frame_surface, surface.get_size(), surface)
+    return frame_surface
 
 def next_elem(xs, y):
     for i in range(len(xs)):
         if xs[i] == y:
             return xs[(i + 1) % len(xs)]
 
+def positive(s):
+    # An argparse type for counts that must be at least 1.
+    n = int(s)
+    if n < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+    return n
+
+def non_negative(s):
+    n = int(s)
+    if n < 0:
+        raise argparse.ArgumentTypeError('must not be negative')
+    return n
+
+def add_app_arguments(arg_parser):
+    # Settings shared by all the example programs.
+    arg_parser.add_argument('--pipeline', action='store_true',
+                            help='render the next frame while showing the current one (adds one frame of latency)')
+    arg_parser.add_argument('--frame-budget', type=float, metavar='MS',
+                            help='adjust the draw distance to keep the time to render a frame near this many milliseconds (e.g. 16.7 for 60 FPS)')
+    arg_parser.add_argument('--render-scale', type=float, default=1.0,
+                            metavar='FACTOR',
+                            help='render at this fraction of the window resolution and scale up (defaults to 1)')
+    arg_parser.add_argument('--min-render-scale', type=float, metavar='FACTOR',
+                            help='let --frame-budget lower the render scale down to this before lowering the draw distance')
+    arg_parser.add_argument('--record', metavar='PATH',
+                            help='render without a window and write the frames to PATH instead')
+    arg_parser.add_argument('--record-format', choices=['raw', 'png'],
+                            default='raw',
+                            help='write one file of RGB24 frames, or a directory of PNG files (defaults to raw)')
+    arg_parser.add_argument('--frames', type=positive, metavar='N',
+                            help='the number of frames to record (defaults to the length of the camera path, or 360)')
+    arg_parser.add_argument('--camera-path', metavar='FILE',
+                            help='record along the cameras in FILE, one "x y z angle_x angle_y angle_z" per line (defaults to turning around once)')
+    arg_parser.add_argument('--backend', choices=['auto'] + futhark_backends,
+                            help='the Futhark backend to render with (defaults to $FUTRACER_BACKEND, or the first one that works)')
+
+class FFIArray:
+    # An array in a library built with futhark_ffi, with the parts of the
+    # pyopencl array interface that FutRacer uses.  It is only copied out of
+    # the library when it is read, under the lock of the library.
+    def __init__(self, futhark, data, lock):
+        self.futhark = futhark
+        self.data = data
+        self.lock = lock
+        self.host = None
+
+    def numpy(self):
+        with self.lock:
+            if self.host is None:
+                self.host = self.futhark.from_futhark(self.data)
+        return self.host
+
+    @property
+    def shape(self):
+        return self.numpy().shape
+
+    @property
+    def dtype(self):
+        return self.numpy().dtype
+
+    def get(self, ary=None):
+        if ary is None:
+            return self.numpy().copy()
+        ary[...] = self.numpy()
+        return ary
+
+class FFIQueue:
+    def __init__(self, futhark, lock):
+        self.futhark = futhark
+        self.lock = lock
+
+    def finish(self):
+        with self.lock:
+            self.futhark.lib.futhark_context_sync(self.futhark.ctx)
+
+class FFILibrary:
+    # Makes a library built with the C or multicore backend and futhark_ffi
+    # look like one built with futhark pyopencl.
+    def __init__(self, futhark):
+        self.futhark = futhark
+        # Arrays and the queue use the context outside of entry calls, so they
+        # share this lock with LockedLibrary.
+        self.lock = threading.RLock()
+        self.queue = FFIQueue(futhark, self.lock)
+
+    def wrap(self, x):
+        if isinstance(x, self.futhark.ffi.CData):
+            return FFIArray(self.futhark, x, self.lock)
+        return x
+
+    def __getattr__(self, name):
+        entry = getattr(self.futhark, name)
+        def call(*args):
+            result = entry(*(x.data if isinstance(x, FFIArray) else x
+                             for x in args))
+            if isinstance(result, (tuple, list)):
+                return tuple(self.wrap(x) for x in result)
+            return self.wrap(result)
+        return call
+
+def load_futhark_library(backend=None):
+    # Returns the library and the name of its backend.  With 'auto', use the
+    # first backend in futhark_backends that is built and can start.
+    if backend is None:
+        backend = os.environ.get('FUTRACER_BACKEND', 'auto')
+    if backend == 'auto':
+        errors = []
+        for backend in futhark_backends:
+            try:
+                return load_futhark_library(backend)
+            except Exception as e:
+                errors.append('{}: {}'.format(backend, e))
+        raise RuntimeError('no Futhark backend works; run make (see the README)\n'
+                           + '\n'.join(errors))
+    if backend == 'opencl':
+        import futracerlib
+        return futracerlib.futracerlib(), backend
+    elif backend in futhark_backends:
+        import futhark_ffi
+        module = importlib.import_module('_futracerlib_' + backend)
+        return FFILibrary(futhark_ffi.Futhark(module)), backend
+    else:
+        raise ValueError('unknown Futhark backend: {}'.format(backend))
+
+class LockedLibrary:
+    # Futhark contexts must not be used from two threads at once, and a
+    # FramePipeline reads frames back in a second thread.  Entry points are
+    # called under the lock here, and readback takes the same lock (see
+    # FutRacer.from_device and FFIArray).
+    def __init__(self, library):
+        self.library = library
+        if isinstance(library, FFILibrary):
+            self.lock = library.lock
+        else:
+            self.lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.library, name)
+        if not callable(attr):
+            return attr
+        def locked(*args):
+            with self.lock:
+                return attr(*args)
+        return locked
+
+def rotate_points_host(angles, points):
+    # The same rotation as rotate_point in transformations.fut, around origo,
+    # for an (n, 3) array of points.
+    sin_x, sin_y, sin_z = numpy.sin(angles)
+    cos_x, cos_y, cos_z = numpy.cos(angles)
+    x0, y0, z0 = points[:, 0], points[:, 1], points[:, 2]
+    # X axis.
+    x1, y1, z1 = x0, y0 * cos_x - z0 * sin_x, y0 * sin_x + z0 * cos_x
+    # Y axis.
+    x2, y2, z2 = z1 * sin_y + x1 * cos_y, y1, z1 * cos_y - x1 * sin_y
+    # Z axis.
+    x3, y3, z3 = x2 * cos_z - y2 * sin_z, x2 * sin_z + y2 * cos_z, z2
+    return numpy.stack((x3, y3, z3), axis=1)
+
+def preprocess_triangles_arrays(vertices, surfaces):
+    # vertices is an (N, 3, 3) array of points, and surfaces is an (N,)
+    # array of surface_dtype.
+    n = len(vertices)
+    coords = numpy.ascontiguousarray(
+        numpy.reshape(numpy.asarray(vertices, dtype='float32'), (n, 9)).T)
+    (x0s, y0s, z0s, x1s, y1s, z1s, x2s, y2s, z2s) = coords
+
+    s_types = numpy.ascontiguousarray(surfaces['type'], dtype='int32')
+    s_hsvs = numpy.ascontiguousarray(surfaces['hsv'].T, dtype='float32')
+    s_hsv_hs, s_hsv_ss, s_hsv_vs = s_hsvs
+    s_indices = numpy.ascontiguousarray(surfaces['index'], dtype='int32')
+
+    return (x0s, y0s, z0s, x1s, y1s, z1s, x2s, y2s, z2s,
+            s_types, s_hsv_hs, s_hsv_ss, s_hsv_vs, s_indices)
+
+def compact_textures(triangles_pre):
+    # Find the double textures that the triangles actually use, and renumber
+    # the texture indices to match a texture list with only those.  Returns
+    # the new triangles and the old double texture indices in their new
+    # order.
+    s_types = triangles_pre[9]
+    s_indices = triangles_pre[13]
+    textured = s_types & 3 == 2
+    double_indices = s_indices[textured] // 2
+    used = numpy.unique(double_indices)
+    s_indices_new = s_indices.copy()
+    s_indices_new[textured] = (
+        numpy.searchsorted(used, double_indices).astype('int32') * 2
+        + (s_indices[textured] & 1))
+    return tuple(triangles_pre[:13]) + (s_indices_new,), used
+
+def build_spatial_grid(triangles_pre, cell_size, origo=None, block=1):
+    # Sort the triangles by the grid cell of their centroid.  Returns the
+    # sorted triangles and a SpatialGrid over them.  The cells are ordered in
+    # square blocks of block x block cells, so that the triangles of a block
+    # are a contiguous range too.
+    vertices = numpy.stack(
+        [numpy.stack(triangles_pre[i:i + 3], axis=1) for i in (0, 3, 6)],
+        axis=1)
+    centroids = vertices.mean(axis=1)
+    if origo is None:
+        if len(centroids) > 0:
+            origo = (centroids[:, 0].min(), centroids[:, 2].min())
+        else:
+            origo = (0.0, 0.0)
+
+    cells_x = numpy.floor((centroids[:, 0] - origo[0]) / cell_size).astype('int64')
+    cells_z = numpy.floor((centroids[:, 2] - origo[1]) / cell_size).astype('int64')
+    cells_x = numpy.maximum(cells_x, 0)
+    cells_z = numpy.maximum(cells_z, 0)
+    n_x = (int(cells_x.max()) // block + 1) * block if len(cells_x) > 0 else block
+    n_z = (int(cells_z.max()) // block + 1) * block if len(cells_z) > 0 else block
+    blocks = (cells_z // block) * (n_x // block) + cells_x // block
+    cells = (blocks * block + cells_z % block) * block + cells_x % block
+    n_cells = n_x * n_z
+
+    order = numpy.argsort(cells, kind='stable')
+    triangles_sorted = tuple(xs[order] for xs in triangles_pre)
+
+    counts = numpy.bincount(cells, minlength=n_cells)
+    cell_starts = numpy.zeros(n_cells + 1, dtype='int64')
+    numpy.cumsum(counts, out=cell_starts[1:])
+
+    mins = numpy.full((n_cells, 3), numpy.inf, dtype='float32')
+    maxs = numpy.full((n_cells, 3), -numpy.inf, dtype='float32')
+    numpy.minimum.at(mins, cells, vertices.min(axis=1))
+    numpy.maximum.at(maxs, cells, vertices.max(axis=1))
+    mins[counts == 0] = 0
+    maxs[counts == 0] = 0
+
+    areas = numpy.linalg.norm(numpy.cross(vertices[:, 1] - vertices[:, 0],
+                                          vertices[:, 2] - vertices[:, 0]),
+                              axis=1) / 2
+    cell_areas = numpy.bincount(cells, weights=areas, minlength=n_cells)
+
+    grid = SpatialGrid(cell_size, origo, (n_x, n_z), cell_starts, mins, maxs,
+                       cell_areas, block)
+    return triangles_sorted, grid
+
+class SpatialGrid:
+    # A uniform grid over the x/z plane.  The triangles are sorted by the cell
+    # of their centroid (see build_spatial_grid), so the triangles of a cell
+    # are a contiguous range, and every cell keeps the bounding box of its
+    # triangles.  A query returns the ranges of the cells that can be in view;
+    # the renderer then only looks at those triangles.  The grid only holds
+    # these small per-cell arrays, so it can be saved and shared without the
+    # triangles.
+    def __init__(self, cell_size, origo, n_cells_xz, cell_starts, cell_mins,
+                 cell_maxs, cell_areas, block=1):
+        self.cell_size = cell_size
+        self.origo = tuple(origo)
+        self.n_x, self.n_z = n_cells_xz
+        self.block = block
+        self.cell_starts = cell_starts
+        self.cell_mins = cell_mins
+        self.cell_maxs = cell_maxs
+        self.cell_areas = cell_areas
+        self.cell_used = numpy.diff(cell_starts) > 0
+        self.cell_centers = (cell_mins + cell_maxs) / 2
+        self.cell_radii = numpy.linalg.norm(cell_maxs - cell_mins, axis=1) / 2
+
+    def block_starts(self):
+        # Where the triangles of every block start, plus the total.
+        return self.cell_starts[::self.block * self.block]
+
+    def select_blocks(self, blocks):
+        # The grid over only the triangles of blocks, an increasing array of
+        # block indices, in the order they come in the full grid.
+        counts = numpy.diff(self.cell_starts).reshape(-1, self.block * self.block)
+        selected = numpy.zeros_like(counts)
+        selected[blocks] = counts[blocks]
+        cell_starts = numpy.zeros_like(self.cell_starts)
+        numpy.cumsum(selected.reshape(-1), out=cell_starts[1:])
+        return SpatialGrid(self.cell_size, self.origo, (self.n_x, self.n_z),
+                           cell_starts, self.cell_mins, self.cell_maxs,
+                           self.cell_areas, self.block)
+
+    def visible_cells(self, camera, size, view_dist, draw_dist):
+        # Conservative: a cell is only dropped if its bounding sphere lies
+        # entirely behind the camera, beyond draw_dist, or outside one of the
+        # side planes of the view frustum.  Also returns the depth of the cell
+        # centers.
+        (c, a) = camera
+        centers = rotate_points_host(-numpy.asarray(a, dtype='float32'),
+                                     self.cell_centers - numpy.asarray(c, dtype='float32'))
+        x, y, z = centers[:, 0], centers[:, 1], centers[:, 2]
+        r = self.cell_radii
+        in_view = self.cell_used & (z + r >= 0) & (z - r < draw_dist)
+
+        # The projection has its eye at (0, 0, -view_dist).  Allow a pixel of
+        # slack for the rounding in the projection.
+        w, h = size
+        z_eye = z + view_dist
+        in_frustum = numpy.ones_like(in_view)
+        for xy, extent in ((x, w), (y, h)):
+            k = (extent / 2 + 1) / view_dist
+            norm = numpy.sqrt(1 + k * k)
+            in_frustum &= (xy - k * z_eye) / norm <= r
+            in_frustum &= (-xy - k * z_eye) / norm <= r
+        # Points behind the camera are not projected with a real perspective,
+        # so only use the frustum for cells fully in front of it.
+        in_view &= in_frustum | (z - r < 0)
+        return in_view, z
+
+    def query(self, camera, size, view_dist, draw_dist):
+        in_view, _ = self.visible_cells(camera, size, view_dist, draw_dist)
+
+        # Empty cells can join neighbouring ranges for free.
+        selected = (in_view | ~self.cell_used).astype('int8')
+        edges = numpy.diff(numpy.concatenate(([0], selected, [0])))
+        begins = numpy.flatnonzero(edges == 1)
+        ends = numpy.flatnonzero(edges == -1)
+        starts = self.cell_starts[begins]
+        lens = self.cell_starts[ends] - starts
+        nonempty = lens > 0
+        return (starts[nonempty], lens[nonempty])
+
+    def covered_area(self, camera, size, view_dist, draw_dist):
+        # A rough estimate of how many pixels the triangles in view cover,
+        # counting overlaps: the area of every cell shrunk by the perspective
+        # at its center.
+        in_view, z = self.visible_cells(camera, size, view_dist, draw_dist)
+        scale = view_dist / (view_dist + numpy.maximum(z[in_view], 0))
+        return float((self.cell_areas[in_view] * scale * scale).sum())
+
+class DeviceScene:
+    def __init__(self, triangles, textures, ranges, n_triangles):
+        # Both are in the same format as the output of preprocess_triangles and
+        # preprocess_textures, except that the arrays live in the Futhark
+        # context.  ranges is a single range covering all triangles.
+        self.triangles = triangles
+        self.textures = textures
+        self.ranges = ranges
+        self.n_triangles = n_triangles
+
+class Scene:
+    def __init__(self, static, grid=None):
+        # static is a DeviceScene that is uploaded once.  Each dynamic layer is
+        # a small preprocessed triangle set that is expected to be replaced
+        # every frame.  If grid is given, static must have been uploaded from
+        # the triangles sorted along with it, and only the cells in view are
+        # rendered.
+        self.static = static
+        self.grid = grid
+        self.layers = {}
+
+    def set_layer(self, name, triangles_pre):
+        self.layers[name] = triangles_pre
+
+    def remove_layer(self, name):
+        self.layers.pop(name, None)
+
+    def copy(self):
+        scene = Scene(self.static, self.grid)
+        scene.layers = self.layers.copy()
+        return scene
+
+    def dynamic_triangles(self):
+        layers = list(self.layers.values())
+        if len(layers) == 0:
+            return None
+        elif len(layers) == 1:
+            return tuple(layers[0])
+        else:
+            return tuple(numpy.concatenate(xss) for xss in zip(*layers))
+
+    def n_dynamic_triangles(self):
+        return sum(len(layer[0]) for layer in self.layers.values())
+
+class RenderCostModel:
+    # Predicts the frame time of every rendering approach with a linear model
+    # of the number of triangles, the covered area, the number of pixels, and
+    # triangles times pixels (for the raycasters).  The models are fitted to a
+    # calibration pass and then to the frames that are actually rendered.
+    def __init__(self, render_approaches=None, max_samples=200, refit_every=30):
+        if render_approaches is None:
+            render_approaches = list(render_approaches_map.keys())
+        self.render_approaches = render_approaches
+        self.max_samples = max_samples
+        self.refit_every = refit_every
+        self.samples = {approach: [] for approach in render_approaches}
+        self.coefficients = {}
+        self.n_new_samples = 0
+        self.calibrated = False
+
+    def features(self, n_triangles, covered_area, size):
+        w, h = size
+        pixels = w * h
+        return numpy.array([1.0, n_triangles, covered_area, pixels,
+                            n_triangles * pixels / 10**6], dtype='float64')
+
+    def fit(self, render_approach):
+        samples = self.samples[render_approach]
+        if not samples:
+            return
+        xs = numpy.array([features for features, _ in samples])
+        ys = numpy.array([frame_ms for _, frame_ms in samples])
+        # Least squares with the coefficients kept non-negative, so that more
+        # work never predicts less time.
+        active = numpy.ones(xs.shape[1], dtype=bool)
+        coefficients = numpy.zeros(xs.shape[1])
+        while active.any():
+            coefficients[:] = 0
+            coefficients[active] = numpy.linalg.lstsq(xs[:, active], ys,
+                                                      rcond=None)[0]
+            if (coefficients >= 0).all():
+                break
+            active &= coefficients > 0
+        self.coefficients[render_approach] = coefficients
+
+    def predict(self, render_approach, features):
+        return float(self.coefficients[render_approach] @ features)
+
+    def choose(self, features):
+        # The approach with the lowest predicted time, and that time.
+        return min(((render_approach, self.predict(render_approach, features))
+                    for render_approach in self.coefficients),
+                   key=lambda p: p[1])
+
+    def add_sample(self, render_approach, features, frame_ms):
+        samples = self.samples[render_approach]
+        samples.append((features, frame_ms))
+        del samples[:-self.max_samples]
+        self.n_new_samples += 1
+        if self.n_new_samples % self.refit_every == 0:
+            self.fit(render_approach)
+
+    def calibrate(self, racer, scene, camera, size, view_dist, draw_dist,
+                  n_draw_rects=(1, 1), max_frame_ms=1000.0):
+        # Render the scene with every approach from a few directions and at
+        # two resolutions.  Approaches that are too slow are only measured
+        # until they exceed max_frame_ms.
+        (c, (a_x, a_y, a_z)) = camera
+        w, h = size
+        poses = [((c, (a_x, a_y + turn, a_z)), pose_size)
+                 for turn in (0.0, numpy.pi / 2, numpy.pi, numpy.pi * 3 / 2)
+                 for pose_size in ((w, h), (max(1, w // 2), max(1, h // 2)))]
+        for render_approach in self.render_approaches:
+            # Warm up.
+            racer.from_device(racer.render_scene(
+                size, view_dist, draw_dist, camera, scene,
+                render_approach, n_draw_rects))
+            for pose_camera, pose_size in poses:
+                ranges, n_triangles = racer.visible_ranges(
+                    pose_size, view_dist, draw_dist, pose_camera, scene)
+                if isinstance(scene, Scene):
+                    n_triangles += scene.n_dynamic_triangles()
+                features = self.features(
+                    n_triangles,
+                    racer.estimate_covered_area(pose_size, view_dist, draw_dist,
+                                                pose_camera, scene),
+                    pose_size)
+                time_start = time.time()
+                racer.from_device(racer.render_scene(
+                    pose_size, view_dist, draw_dist, pose_camera, scene,
+                    render_approach, n_draw_rects, ranges))
+                frame_ms = (time.time() - time_start) * 1000
+                self.samples[render_approach].append((features, frame_ms))
+                if frame_ms > max_frame_ms:
+                    break
+            self.fit(render_approach)
+        self.calibrated = True
+
+class FrameBudget:
+    # Keeps the time to render a frame near target_ms by scaling the draw
+    # distance, and, if min_render_scale is given, the render scale.  The frame
+    # time is smoothed, small deviations are ignored, and every step is
+    # limited, so that it does not oscillate.  The work grows roughly with the
+    # square of both, so a step of factor f is expected to change the frame
+    # time by f ** 2; the smoothed time is corrected by that right away instead
+    # of waiting for the new frames, which would overshoot (especially when
+    # pipelined).
+    #
+    # When over budget, the render scale is lowered before the draw distance,
+    # and when under budget, it is raised back to 1 first.
+    def __init__(self, target_ms, min_draw_dist=100.0, max_draw_dist=100000.0,
+                 min_render_scale=None, smoothing=0.1, tolerance=0.1,
+                 max_step=1.05, log_every=1.0):
+        self.target_ms = target_ms
+        self.min_draw_dist = min_draw_dist
+        self.max_draw_dist = max_draw_dist
+        self.min_render_scale = min_render_scale
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.max_step = max_step
+        self.log_every = log_every
+        self.smoothed_ms = None
+        self.logged_settings = None
+        self.logged_time = 0.0
+
+    def update(self, frame_ms, draw_dist, render_scale=1.0):
+        # Returns the draw distance and render scale to use from now on.
+        if self.smoothed_ms is None:
+            self.smoothed_ms = frame_ms
+        else:
+            self.smoothed_ms += self.smoothing * (frame_ms - self.smoothed_ms)
+
+        ratio = self.target_ms / max(self.smoothed_ms, 0.001)
+        if abs(ratio - 1) <= self.tolerance:
+            return draw_dist, render_scale
+        step = min(max(ratio ** 0.5, 1 / self.max_step), self.max_step)
+
+        draw_dist_new, render_scale_new = draw_dist, render_scale
+        if (self.min_render_scale is not None
+            and ((step < 1 and render_scale > self.min_render_scale)
+                 or (step > 1 and render_scale < 1))):
+            render_scale_new = min(max(render_scale * step,
+                                       self.min_render_scale), 1.0)
+            effect = render_scale_new / render_scale
+        else:
+            draw_dist_new = min(max(draw_dist * step, self.min_draw_dist),
+                                self.max_draw_dist)
+            effect = draw_dist_new / draw_dist if draw_dist > 0 else 1.0
+
+        if (draw_dist_new, render_scale_new) != (draw_dist, render_scale):
+            self.smoothed_ms *= effect ** 2
+            self.log((draw_dist, render_scale),
+                     (draw_dist_new, render_scale_new))
+        return draw_dist_new, render_scale_new
+
+    def log(self, settings, settings_new):
+        if self.logged_settings is None:
+            self.logged_settings = settings
+        now = time.time()
+        if now - self.logged_time >= self.log_every:
+            (draw_dist, render_scale) = self.logged_settings
+            (draw_dist_new, render_scale_new) = settings_new
+            print('frame budget: {:.02f} ms (target {:.02f} ms); draw distance {:.02f} -> {:.02f}; render scale {:.02f} -> {:.02f}'.format(
+                self.smoothed_ms, self.target_ms,
+                draw_dist, draw_dist_new,
+                render_scale, render_scale_new), file=sys.stderr)
+            self.logged_settings = None
+            self.logged_time = now
+
+class DrawRectsSearch:
+    def __init__(self, start):
+        self.current = start
+        self.measured = {}
+        self.queue = [start]
+        self.samples = []
+
+class DrawRectsTuner:
+    # Finds the number of draw rectangles that gives the lowest frame time for
+    # the chunked approach.  It hill-climbs over powers of two, measuring every
+    # candidate for a few frames, and caches the best value per resolution and
+    # triangle count, so it only searches again when either of them changes a
+    # lot.
+    def __init__(self, max_rects=32, frames_per_candidate=4):
+        self.max_rects = max_rects
+        self.frames_per_candidate = frames_per_candidate
+        self.best = {}
+        self.searches = {}
+
+    def key(self, size, n_triangles):
+        # Triangle counts within a factor of two share a key.
+        return (tuple(size), int(n_triangles).bit_length())
+
+    def neighbours(self, n_draw_rects):
+        x, y = n_draw_rects
+        return [(x1, y1) for x1, y1 in ((x * 2, y), (x // 2, y),
+                                        (x, y * 2), (x, y // 2))
+                if 1 <= x1 <= self.max_rects and 1 <= y1 <= self.max_rects]
+
+    def choose(self, size, n_triangles):
+        key = self.key(size, n_triangles)
+        if key in self.best:
+            return self.best[key]
+        search = self.searches.get(key)
+        if search is None:
+            # Start from the best value for the closest triangle count, if any.
+            known = [(abs(key[1] - other[1]), n_draw_rects)
+                     for other, n_draw_rects in self.best.items()
+                     if other[0] == key[0]]
+            search = DrawRectsSearch(min(known)[1] if known else (1, 1))
+            self.searches[key] = search
+        return search.queue[0]
+
+    def report(self, size, n_triangles, n_draw_rects, frame_ms):
+        # Report the frame time of a frame rendered with the n_draw_rects that
+        # choose returned for size and n_triangles.
+        key = self.key(size, n_triangles)
+        search = self.searches.get(key)
+        if search is None or search.queue[0] != tuple(n_draw_rects):
+            return
+        search.samples.append(frame_ms)
+        if len(search.samples) < self.frames_per_candidate:
+            return
+        search.measured[search.queue.pop(0)] = sorted(search.samples)[
+            len(search.samples) // 2]
+        search.samples = []
+        while not search.queue:
+            candidates = [search.current] + self.neighbours(search.current)
+            search.queue = [n_draw_rects for n_draw_rects in candidates
+                            if n_draw_rects not in search.measured]
+            if search.queue:
+                return
+            best = min(candidates,
+                       key=lambda n_draw_rects: search.measured[n_draw_rects])
+            if best == search.current:
+                self.best[key] = best
+                del self.searches[key]
+                return
+            search.current = best
+
+class FramePlanner:
+    # Picks the settings of the next frame: the rendering approach when it is
+    # 'auto', and the number of draw rectangles for chunked while
+    # tune_draw_rects is set.  Push the tag from plan along with the frame, and
+    # report it back with the frame time once the frame has been shown.
+    def __init__(self, racer):
+        self.racer = racer
+        self.draw_rects_tuner = DrawRectsTuner()
+        self.tune_draw_rects = True
+        self.cost_model = RenderCostModel()
+        # The settings and times of the last reported frame.
+        self.render_approach = None
+        self.predicted_ms = None
+        self.actual_ms = None
+
+    def plan(self, size, view_dist, draw_dist, camera, scene,
+             render_approach, n_draw_rects, render_scale=1.0):
+        # Returns the rendering approach, the number of draw rectangles, the
+        # ranges for render_scene, and the tag.
+        ranges, n_triangles = self.racer.visible_ranges(
+            size, view_dist, draw_dist, camera, scene)
+        frame_size = scaled_size(size, render_scale)
+        if isinstance(scene, Scene):
+            n_triangles += scene.n_dynamic_triangles()
+
+        features = None
+        predicted_ms = None
+        if render_approach == 'auto':
+            if not self.cost_model.calibrated:
+                self.cost_model.calibrate(self.racer, scene, camera, size,
+                                          view_dist, draw_dist, n_draw_rects)
+            # The covered area shrinks with the resolution.
+            features = self.cost_model.features(
+                n_triangles,
+                self.racer.estimate_covered_area(size, view_dist, draw_dist,
+                                                 camera, scene)
+                * render_scale ** 2,
+                frame_size)
+            render_approach, predicted_ms = self.cost_model.choose(features)
+
+        if render_approach == 'chunked' and self.tune_draw_rects:
+            n_draw_rects = self.draw_rects_tuner.choose(frame_size,
+                                                        n_triangles)
+        n_draw_rects = tuple(n_draw_rects)
+
+        tag = (render_approach, frame_size, n_draw_rects, n_triangles,
+               features, predicted_ms)
+        return render_approach, n_draw_rects, ranges, tag
+
+    def report(self, tag, frame_ms):
+        (render_approach, size, n_draw_rects, n_triangles,
+         features, predicted_ms) = tag
+        if render_approach == 'chunked' and self.tune_draw_rects:
+            self.draw_rects_tuner.report(size, n_triangles, n_draw_rects,
+                                         frame_ms)
+        if features is not None:
+            self.cost_model.add_sample(render_approach, features, frame_ms)
+        self.render_approach = render_approach
+        self.predicted_ms = predicted_ms
+        self.actual_ms = frame_ms
+
 class FutRacer:
-    def __init__(self):
-        self.futhark = futracerlib.futracerlib()
+    def __init__(self, backend=None):
+        library, self.backend = load_futhark_library(backend)
+        self.futhark = LockedLibrary(library)
+        self.empty_triangles_dev = None
+
+    def to_device(self, xs):
+        to_device_raw = {
+            numpy.dtype('float32'): self.futhark.to_device_f32_raw,
+            numpy.dtype('int32'): self.futhark.to_device_i32_raw,
+            numpy.dtype('uint32'): self.futhark.to_device_u32_raw,
+            numpy.dtype('int64'): self.futhark.to_device_i64_raw,
+        }[xs.dtype]
+        return to_device_raw(xs)
+
+    def join_ranges(self, xs, ys, starts, lens):
+        join_ranges_raw = {
+            numpy.dtype('float32'): self.futhark.join_ranges_f32_raw,
+            numpy.dtype('int32'): self.futhark.join_ranges_i32_raw,
+        }[xs.dtype]
+        return join_ranges_raw(xs, ys, starts, lens)
+
+    def from_device(self, xs, out=None):
+        if isinstance(xs, FFIArray):
+            return xs.get(ary=out)
+        # Only queue the copy under the lock, and wait for it outside, so that
+        # another thread can queue work in the meantime.
+        with self.futhark.lock:
+            ary, event = xs.get_async(ary=out)
+        # Empty arrays are not copied at all.
+        if event is not None:
+            event.wait()
+        return ary
+
+    def sync(self):
+        # Wait for all queued work to finish.
+        self.futhark.queue.finish()
 
     def rgb8_to_hsv(self, rgb8):
         r8, g8, b8 = rgb8
@@ -47,81 +802,157 @@ class FutRacer:
         return [self.rotate_point(angles, origo, p)
                 for p in triangle[:3]] + triangle[3:]
 
+    def point_columns(self, points, n):
+        # Broadcast a single point or an (n, 3) array of points to three
+        # contiguous coordinate arrays.
+        points = numpy.broadcast_to(numpy.asarray(points, dtype='float32'),
+                                    (n, 3))
+        return tuple(numpy.ascontiguousarray(points[:, i]) for i in range(3))
+
+    def points_from_device(self, columns):
+        return numpy.stack([self.from_device(xs) for xs in columns], axis=1)
+
+    def translate_points(self, moves, points):
+        # moves is either one move or one per point.
+        n = len(points)
+        args = self.point_columns(moves, n) + self.point_columns(points, n)
+        return self.points_from_device(self.futhark.translate_points_raw(*args))
+
+    def rotate_points(self, angles, origos, points):
+        # angles and origos are either shared or given per point.
+        n = len(points)
+        args = (self.point_columns(angles, n) + self.point_columns(origos, n)
+                + self.point_columns(points, n))
+        return self.points_from_device(self.futhark.rotate_points_raw(*args))
+
     def to_numpy(self, xs, typ):
         return numpy.fromiter(xs, dtype=typ)
 
     def preprocess_triangles(self, triangles):
-        p0s = [t[0] for t in triangles]
-        p1s = [t[1] for t in triangles]
-        p2s = [t[2] for t in triangles]
-        ss = [t[3] for t in triangles]
+        vertices = numpy.array([t[:3] for t in triangles], dtype='float32')
+        surfaces = numpy.array([tuple(t[3]) for t in triangles],
+                               dtype=surface_dtype)
+        return self.preprocess_triangles_arrays(
+            numpy.reshape(vertices, (len(triangles), 3, 3)), surfaces)
 
-        x0s = self.to_numpy((p[0] for p in p0s), 'float32')
-        y0s = self.to_numpy((p[1] for p in p0s), 'float32')
-        z0s = self.to_numpy((p[2] for p in p0s), 'float32')
+    def preprocess_triangles_arrays(self, vertices, surfaces):
+        return preprocess_triangles_arrays(vertices, surfaces)
 
-        x1s = self.to_numpy((p[0] for p in p1s), 'float32')
-        y1s = self.to_numpy((p[1] for p in p1s), 'float32')
-        z1s = self.to_numpy((p[2] for p in p1s), 'float32')
+    def rgb8s_to_hsvs(self, rgb8s):
+        # The same as rgb8_to_hsv, but for a whole (..., 3) array at once.
+        rgbs = numpy.asarray(rgb8s, dtype='float64') / 255.0
+        r, g, b = rgbs[..., 0], rgbs[..., 1], rgbs[..., 2]
+        maxc = numpy.max(rgbs, axis=-1)
+        minc = numpy.min(rgbs, axis=-1)
+        rangec = maxc - minc
+        gray = rangec == 0.0
+        rangec_safe = numpy.where(gray, 1.0, rangec)
+        maxc_safe = numpy.where(gray, 1.0, maxc)
+        rc = (maxc - r) / rangec_safe
+        gc = (maxc - g) / rangec_safe
+        bc = (maxc - b) / rangec_safe
+        h = numpy.where(r == maxc, bc - gc,
+                        numpy.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+        h = numpy.where(gray, 0.0, (h / 6.0) % 1.0)
+        s = numpy.where(gray, 0.0, rangec / maxc_safe)
+        v = maxc
+        return numpy.stack((h * 360.0, s, v), axis=-1).astype('float32')
 
-        x2s = self.to_numpy((p[0] for p in p2s), 'float32')
-        y2s = self.to_numpy((p[1] for p in p2s), 'float32')
-        z2s = self.to_numpy((p[2] for p in p2s), 'float32')
+    def hsvs_to_rgb8s(self, hsvs):
+        # The same as hsv_to_rgb in color.fut, for a whole (..., 3) array.
+        hsvs = numpy.asarray(hsvs, dtype='float32')
+        h, s, v = hsvs[..., 0], hsvs[..., 1], hsvs[..., 2]
+        c = v * s
+        h1 = h / numpy.float32(60.0)
+        h1_mod_2 = h1 - numpy.trunc(h1 / numpy.float32(2.0)) * numpy.float32(2.0)
+        x = c * (numpy.float32(1.0) - numpy.abs(h1_mod_2 - numpy.float32(1.0)))
+        zero = numpy.zeros_like(c)
+        sectors = [(0.0 <= h1) & (h1 < 1.0),
+                   (1.0 <= h1) & (h1 < 2.0),
+                   (2.0 <= h1) & (h1 < 3.0),
+                   (3.0 <= h1) & (h1 < 4.0),
+                   (4.0 <= h1) & (h1 < 5.0),
+                   (5.0 <= h1) & (h1 < 6.0)]
+        r0 = numpy.select(sectors, [c, x, zero, zero, x, c], zero)
+        g0 = numpy.select(sectors, [x, c, c, x, zero, zero], zero)
+        b0 = numpy.select(sectors, [zero, zero, x, c, c, x], zero)
+        m = v - c
+        rgbs = numpy.stack((r0 + m, g0 + m, b0 + m), axis=-1)
+        return (numpy.float32(255.0) * rgbs).astype('uint8')
 
-        s_types = self.to_numpy((s[0] for s in ss), 'int32')
-        s_hsv_hs = self.to_numpy((s[1][0] for s in ss), 'float32')
-        s_hsv_ss = self.to_numpy((s[1][1] for s in ss), 'float32')
-        s_hsv_vs = self.to_numpy((s[1][2] for s in ss), 'float32')
-        s_indices = self.to_numpy((s[2] for s in ss), 'int32')
-
-        return (x0s, y0s, z0s, x1s, y1s, z1s, x2s, y2s, z2s,
-                s_types, s_hsv_hs, s_hsv_ss, s_hsv_vs, s_indices)
+    def pack_rgb8s(self, rgb8s):
+        # Pack (..., 3) RGB values into pixels like rgb_to_pixel in color.fut.
+        rgbs = numpy.asarray(rgb8s).astype('uint32')
+        return (rgbs[..., 0] << 16) | (rgbs[..., 1] << 8) | rgbs[..., 2]
 
     def load_double_texture(self, path):
+        return self.load_cached_texture(path, 'hsv',
+                                        self.decode_double_texture)
+
+    def load_double_texture_rgb8(self, path):
+        return self.load_cached_texture(path, 'rgb8',
+                                        self.decode_double_texture_rgb8)
+
+    def load_cached_texture(self, path, kind, decode):
+        # Decoding is slow, so keep the result around for the next launch.  The
+        # key changes whenever the PNG file is changed.
+        stat = os.stat(path)
+        key = '{}:{}:{}:{}'.format(os.path.abspath(path),
+                                   stat.st_mtime_ns, stat.st_size, kind)
+        cache_path = os.path.join(
+            cache_dir(), 'textures',
+            hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+        try:
+            return numpy.load(cache_path, mmap_mode='r')
+        except (OSError, ValueError):
+            pass
+
+        texture = decode(path)
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            cache_path_tmp = '{}.{}.tmp'.format(cache_path, os.getpid())
+            with open(cache_path_tmp, 'wb') as f:
+                numpy.save(f, texture)
+            os.replace(cache_path_tmp, cache_path)
+        except OSError:
+            pass # Not being able to cache is fine.
+        return texture
+
+    def decode_double_texture_rgb8(self, path):
         texture_raw = png.Reader(filename=path)
         t_w, t_h, t_pixels, t_meta = texture_raw.asRGB8()
-        n_channels = 3
-        rgbs_1d = numpy.fromiter(itertools.chain(*t_pixels), dtype='uint8')
-        rgbs_2d = numpy.reshape(rgbs_1d, (t_h * t_w, n_channels))
-        hsvs_2d = numpy.fromiter(itertools.chain(*map(self.rgb8_to_hsv, rgbs_2d)), dtype='float32')
-        hsvs_3d = numpy.reshape(hsvs_2d, (t_h, t_w, n_channels))
-        return hsvs_3d
+        return numpy.reshape(
+            numpy.concatenate([numpy.asarray(row, dtype='uint8')
+                               for row in t_pixels]),
+            (t_h, t_w, 3))
+
+    def decode_double_texture(self, path):
+        return self.rgb8s_to_hsvs(self.decode_double_texture_rgb8(path))
 
     def preprocess_textures(self, textures):
+        # Textures can be either RGB8 (from load_double_texture_rgb8) or HSV
+        # (from load_double_texture).  Either way they end up as packed RGB
+        # pixels, which is what the renderer reads.
         if len(textures) == 0:
             # The values will not be used.
-            texture_w = 0
-            texture_h = 0
-        else:
-            # Assume all textures have the same size.  They must have!
-            # Otherwise something will fail later on.
-            t = textures[0]
-            texture_h, texture_w, _channels = t.shape
-
-        if len(textures) > 0:
-            s_textures = numpy.array(textures)
-            s_textures_hs = s_textures[:,:,:,0]
-            s_textures_hs_flat = numpy.reshape(
-                s_textures_hs,
-                len(textures) * texture_h * texture_w)
-            s_textures_hs_flat = self.to_numpy(s_textures_hs_flat, 'float32')
-            s_textures_ss = s_textures[:,:,:,1]
-            s_textures_ss_flat = numpy.reshape(
-                s_textures_ss,
-                len(textures) * texture_h * texture_w).astype('float32')
-            s_textures_ss_flat = self.to_numpy(s_textures_ss_flat, 'float32')
-            s_textures_vs = s_textures[:,:,:,2]
-            s_textures_vs_flat = numpy.reshape(
-                s_textures_vs,
-                len(textures) * texture_h * texture_w).astype('float32')
-            s_textures_vs_flat = self.to_numpy(s_textures_vs_flat, 'float32')
-        else:
-            s_textures_hs_flat = numpy.empty((0,)).astype('float32')
-            s_textures_ss_flat = numpy.empty((0,)).astype('float32')
-            s_textures_vs_flat = numpy.empty((0,)).astype('float32')
+            return (0, 0, 0, numpy.empty((0,), dtype='uint32'))
+
+        # Assume all textures have the same size.  They must have!  Otherwise
+        # something will fail later on.
+        t = textures[0]
+        texture_h, texture_w, _channels = t.shape
+
+        s_textures = numpy.array(textures)
+        if s_textures.dtype != numpy.uint8:
+            s_textures = self.hsvs_to_rgb8s(s_textures)
+        s_textures_flat = numpy.reshape(
+            self.pack_rgb8s(s_textures),
+            len(textures) * texture_h * texture_w)
 
-        return (len(textures), texture_w, texture_h,
-                s_textures_hs_flat, s_textures_ss_flat, s_textures_vs_flat)
+        return (len(textures), texture_w, texture_h, s_textures_flat)
+
+    def compact_textures(self, triangles_pre):
+        return compact_textures(triangles_pre)
 
     def render_triangles_preprocessed(self, size, view_dist, draw_dist, camera,
                                       triangles_pre, textures_pre,
@@ -134,8 +965,7 @@ class FutRacer:
         (x0s, y0s, z0s, x1s, y1s, z1s, x2s, y2s, z2s,
          s_types, s_hsv_hs, s_hsv_ss, s_hsv_vs, s_indices) = triangles_pre
 
-        (textures_len, texture_w, texture_h,
-         s_textures_hs_flat, s_textures_ss_flat, s_textures_vs_flat) = textures_pre
+        (textures_len, texture_w, texture_h, s_textures_flat) = textures_pre
 
         render_approach = render_approaches_map[render_approach]
 
@@ -144,10 +974,113 @@ class FutRacer:
             w, h, view_dist, draw_dist,
             x0s, y0s, z0s, x1s, y1s, z1s, x2s, y2s, z2s,
             s_types, s_hsv_hs, s_hsv_ss, s_hsv_vs, s_indices,
-            textures_len, texture_w, texture_h,
-            s_textures_hs_flat, s_textures_ss_flat, s_textures_vs_flat,
+            textures_len, texture_w, texture_h, s_textures_flat,
             c_x, c_y, c_z, c_ax, c_ay, c_az)
 
+    def upload_textures(self, textures_pre):
+        return (tuple(textures_pre[:3])
+                + tuple(self.to_device(xs) for xs in textures_pre[3:]))
+
+    def upload_scene(self, triangles_pre, textures_pre, textures_dev=None):
+        # Pass textures_dev from upload_textures to share the textures with
+        # another scene.
+        triangles_dev = tuple(self.to_device(xs) for xs in triangles_pre)
+        if textures_dev is None:
+            textures_dev = self.upload_textures(textures_pre)
+        return self.device_scene(triangles_dev, textures_dev,
+                                 len(triangles_pre[0]))
+
+    def device_scene(self, triangles_dev, textures_dev, n_triangles):
+        ranges_dev = (self.to_device(numpy.array([0], dtype='int64')),
+                      self.to_device(numpy.array([n_triangles], dtype='int64')))
+        return DeviceScene(triangles_dev, textures_dev, ranges_dev,
+                           n_triangles)
+
+    def upload_grid_scene(self, triangles_pre, textures_pre, cell_size=None,
+                          origo=None, grid=None, textures_dev=None):
+        # With a prebuilt grid, triangles_pre must already be sorted along
+        # with it, and are uploaded as they are.
+        if grid is None:
+            triangles_pre, grid = build_spatial_grid(triangles_pre, cell_size,
+                                                     origo)
+        return Scene(self.upload_scene(triangles_pre, textures_pre,
+                                       textures_dev), grid)
+
+    def join_grid_scene(self, scene, triangles_pre, starts, lens, grid,
+                        textures_dev):
+        # A scene of the ranges starts/lens of the static triangles of scene
+        # followed by triangles_pre, sorted along with grid.  Only
+        # triangles_pre is uploaded; the rest is copied within the Futhark
+        # context.  Without a scene, the ranges are of triangles_pre.
+        if scene is None:
+            old_dev = self.empty_triangles()
+        else:
+            old_dev = scene.static.triangles
+        new_dev = tuple(self.to_device(xs) for xs in triangles_pre)
+        starts_dev = self.to_device(numpy.asarray(starts, dtype='int64'))
+        lens_dev = self.to_device(numpy.asarray(lens, dtype='int64'))
+        triangles_dev = tuple(self.join_ranges(xs, ys, starts_dev, lens_dev)
+                              for xs, ys in zip(old_dev, new_dev))
+        return Scene(self.device_scene(triangles_dev, textures_dev,
+                                       int(numpy.sum(lens))), grid)
+
+    def empty_triangles(self):
+        if self.empty_triangles_dev is None:
+            vertices = numpy.empty((0, 3, 3), dtype='float32')
+            surfaces = numpy.empty((0,), dtype=surface_dtype)
+            self.empty_triangles_dev = tuple(
+                self.to_device(xs) for xs in
+                self.preprocess_triangles_arrays(vertices, surfaces))
+        return self.empty_triangles_dev
+
+    def visible_ranges(self, size, view_dist, draw_dist, camera, scene):
+        # The ranges of static triangles to render, and how many triangles
+        # they cover.
+        if isinstance(scene, DeviceScene):
+            scene = Scene(scene)
+        if scene.grid is None:
+            return scene.static.ranges, scene.static.n_triangles
+        starts, lens = scene.grid.query(camera, size, view_dist, draw_dist)
+        return (starts, lens), int(lens.sum())
+
+    def estimate_covered_area(self, size, view_dist, draw_dist, camera, scene):
+        if isinstance(scene, Scene) and scene.grid is not None:
+            return scene.grid.covered_area(camera, size, view_dist, draw_dist)
+        w, h = size
+        return float(w * h)
+
+    def render_scene(self, size, view_dist, draw_dist, camera, scene,
+                     render_approach='segmented',
+                     n_draw_rects=(1, 1), ranges=None, render_scale=1.0,
+                     back_face_culling=True):
+        # The frame shows the view of a window of size, but is rendered at
+        # render_scale of its resolution; upscale it when showing it.
+        if isinstance(scene, DeviceScene):
+            scene = Scene(scene)
+
+        w, h = scaled_size(size, render_scale)
+        render_scale = w / size[0]
+
+        ((c_x, c_y, c_z), (c_ax, c_ay, c_az)) = camera
+
+        dynamic_triangles = scene.dynamic_triangles()
+        if dynamic_triangles is None:
+            dynamic_triangles = self.empty_triangles()
+
+        if ranges is None:
+            ranges, _ = self.visible_ranges(size, view_dist, draw_dist,
+                                            camera, scene)
+
+        render_approach = render_approaches_map[render_approach]
+
+        args = ((render_approach, n_draw_rects[0], n_draw_rects[1],
+                 w, h, view_dist, render_scale, draw_dist, back_face_culling)
+                + tuple(scene.static.triangles) + tuple(ranges)
+                + tuple(dynamic_triangles)
+                + tuple(scene.static.textures)
+                + (c_x, c_y, c_z, c_ax, c_ay, c_az))
+        return self.futhark.render_scene_raw(*args)
+
     def render_triangles(self, size, view_dist, draw_dist, camera,
                          triangles, triangles_pre,
                          textures, textures_pre,
@@ -157,23 +1090,231 @@ class FutRacer:
             triangles_pre1 = triangles_pre
         else:
             triangles_pre0 = self.preprocess_triangles(triangles)
-            triangles_pre1 = [numpy.array.concatenate((x, y))
+            triangles_pre1 = [numpy.concatenate((x, y))
                               for x, y in zip(triangles_pre0, triangles_pre)]
         if textures is None:
             textures_pre1 = textures_pre
         else:
-            textures_pre0 = self.preprocess_triangles(textures)
+            textures_pre0 = self.preprocess_textures(textures)
             p0_length, p0_w, p0_h = textures_pre0[:3]
-            p_length, p_w, p_h = textures_pre0[:3]
+            p_length, p_w, p_h = textures_pre[:3]
             length = p0_length + p_length
             assert p0_w == p_w
             assert p0_h == p_h
             textures_pre0_arrays = textures_pre0[3:]
             textures_pre_arrays = textures_pre[3:]
-            triangles_pre1_arrays = [numpy.array.concatenate((x, y))
-                              for x, y in zip(textures_pre0_arrays, textures_pre_arrays)]
-            triangles_pre1 = [length, p0_w, p0_h] + triangles_pre1_arrays
+            textures_pre1_arrays = [numpy.concatenate((x, y))
+                                    for x, y in zip(textures_pre0_arrays, textures_pre_arrays)]
+            textures_pre1 = [length, p0_w, p0_h] + textures_pre1_arrays
         return self.render_triangles_preprocessed(
             size, view_dist, draw_dist, camera,
             triangles_pre1, textures_pre1,
             render_approach, n_draw_rects)
+
+class FramePipeline:
+    # Renders frames and reads them back into two alternating host buffers.
+    # push queues the rendering of a frame on the caller's thread.  When
+    # pipelined, the frame is read back in a second thread, and push then waits
+    # for the previous frame, so the device is already busy with frame N + 1
+    # while frame N is read back and shown; push returns the previous frame
+    # (None on the first call).  Otherwise push just returns the frame it
+    # rendered.  After push, tag is the tag that was pushed along with the
+    # returned frame.
+    def __init__(self, racer, pipelined=False):
+        self.racer = racer
+        self.pipelined = pipelined
+        self.buffers = [None, None]
+        self.buffer_index = 0
+        self.pending = None
+        if pipelined:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.render_ms = 0.0
+        self.get_ms = 0.0
+        self.tag = None
+
+    def get(self, frame, buffer_index, render_ms, tag):
+        time_start = time.time()
+        buffer = self.buffers[buffer_index]
+        if buffer is None or buffer.shape != frame.shape:
+            buffer = numpy.empty(frame.shape, dtype=frame.dtype)
+            self.buffers[buffer_index] = buffer
+        self.racer.from_device(frame, out=buffer)
+        return (buffer, render_ms, (time.time() - time_start) * 1000, tag)
+
+    def push(self, render, tag=None):
+        buffer_index = self.buffer_index
+        self.buffer_index = 1 - self.buffer_index
+        time_start = time.time()
+        frame = render()
+        render_ms = (time.time() - time_start) * 1000
+        if not self.pipelined:
+            result = self.get(frame, buffer_index, render_ms, tag)
+        else:
+            future = self.executor.submit(self.get, frame, buffer_index,
+                                          render_ms, tag)
+            previous, self.pending = self.pending, future
+            if previous is None:
+                return None
+            result = previous.result()
+        frame, self.render_ms, self.get_ms, self.tag = result
+        return frame
+
+    def close(self):
+        if self.pipelined:
+            self.executor.shutdown(wait=True)
+
+def load_camera_path(path, n_frames=None):
+    # One camera per line: the position and the angles.  Lines starting with #
+    # are ignored.  With n_frames, the cameras are keyframes spread evenly over
+    # the frames, and the frames in between get interpolated cameras.
+    keys = numpy.atleast_2d(numpy.loadtxt(path, dtype='float64'))
+    if keys.shape[1] != 6:
+        raise ValueError('{}: expected 6 numbers per camera'.format(path))
+    if n_frames is None or n_frames == len(keys):
+        cameras = keys
+    elif len(keys) == 1:
+        cameras = numpy.repeat(keys, n_frames, axis=0)
+    else:
+        ts = numpy.linspace(0, len(keys) - 1, n_frames)
+        cameras = numpy.stack([numpy.interp(ts, numpy.arange(len(keys)),
+                                            keys[:, j])
+                               for j in range(6)], axis=1)
+    return [(tuple(camera[:3]), tuple(camera[3:])) for camera in cameras]
+
+def recording_cameras(camera_path, n_frames, camera_start):
+    if camera_path is not None:
+        return load_camera_path(camera_path, n_frames)
+    # Stand still and turn around once.
+    if n_frames is None:
+        n_frames = 360
+    position, (a_x, a_y, a_z) = camera_start
+    return [(tuple(position), (a_x, a_y + 2 * numpy.pi * i / n_frames, a_z))
+            for i in range(n_frames)]
+
+class FrameFile:
+    # The output of a recording.  The raw format is a single file of RGB24
+    # frames, which is memory-mapped at its full size up front; play it with
+    # e.g. ffplay -f rawvideo -pixel_format rgb24 -video_size WxH.  The png
+    # format is a directory of numbered PNG files.  Frames can be written in
+    # any order, and by several processes when all but the first open it with
+    # create=False.
+    def __init__(self, path, size, n_frames, record_format='raw', create=True):
+        self.path = path
+        self.size = size
+        w, h = size
+        if record_format == 'raw':
+            self.output = numpy.memmap(path, dtype='uint8',
+                                       mode='w+' if create else 'r+',
+                                       shape=(n_frames, h, w, 3))
+        else:
+            if create:
+                os.makedirs(path, exist_ok=True)
+            self.output = None
+
+    def write(self, i, frame):
+        # Frames are indexed by x first, while images are stored by rows.
+        pixels = frame.T
+        if self.output is not None:
+            rgb = self.output[i]
+        else:
+            rgb = numpy.empty(pixels.shape + (3,), dtype='uint8')
+        rgb[..., 0] = (pixels >> 16) & 255
+        rgb[..., 1] = (pixels >> 8) & 255
+        rgb[..., 2] = pixels & 255
+        if self.output is None:
+            w, h = self.size
+            writer = png.Writer(width=w, height=h, greyscale=False)
+            path = os.path.join(self.path, 'frame-{:06d}.png'.format(i))
+            with open(path, 'wb') as f:
+                writer.write(f, numpy.reshape(rgb, (h, w * 3)))
+
+    def flush(self):
+        if self.output is not None:
+            self.output.flush()
+
+class FrameWriter:
+    # Writes recorded frames to a FrameFile in a second thread, so that
+    # writing overlaps with rendering the next frames.  Frames are read back
+    # into a fixed set of preallocated buffers, and write blocks while all of
+    # them are waiting to be written.
+    def __init__(self, racer, path, size, n_frames, record_format='raw',
+                 n_buffers=4):
+        self.racer = racer
+        w, h = size
+        self.buffers = [numpy.empty((w, h), dtype='uint32')
+                        for _ in range(n_buffers)]
+        self.free = queue.Queue()
+        for buffer_index in range(n_buffers):
+            self.free.put(buffer_index)
+        self.pending = queue.Queue()
+        self.output = FrameFile(path, size, n_frames, record_format)
+        self.n_frames = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, frame):
+        # Read back a rendered frame and queue it for writing.
+        buffer_index = self.free.get()
+        if self.error is not None:
+            raise self.error
+        self.racer.from_device(frame, out=self.buffers[buffer_index])
+        self.pending.put((self.n_frames, buffer_index))
+        self.n_frames += 1
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            i, buffer_index = item
+            if self.error is None:
+                try:
+                    self.output.write(i, self.buffers[buffer_index])
+                except Exception as e:
+                    self.error = e
+            self.free.put(buffer_index)
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        self.output.flush()
+        if self.error is not None:
+            raise self.error
+
+def record_frames(racer, scene, size, view_dist, draw_dist, cameras, path,
+                  record_format='raw', render_approach='segmented',
+                  n_draw_rects=(1, 1), render_scale=1.0, update_scene=None):
+    # Render the frames of a camera path without a window and write them to
+    # path.  update_scene(scene, i) can change the dynamic layers before frame
+    # i.  Progress and the sustained frame rate are logged to standard error.
+    frame_size = scaled_size(size, render_scale)
+    writer = FrameWriter(racer, path, frame_size, len(cameras), record_format)
+    planner = FramePlanner(racer)
+    time_start = time.time()
+    time_logged = time_start
+    try:
+        for i, camera in enumerate(cameras):
+            frame_start = time.time()
+            if update_scene is not None:
+                update_scene(scene, i)
+            approach, n_draw_rects, ranges, tag = planner.plan(
+                size, view_dist, draw_dist, camera, scene, render_approach,
+                n_draw_rects, render_scale)
+            frame = racer.render_scene(size, view_dist, draw_dist, camera,
+                                       scene, approach, n_draw_rects, ranges,
+                                       render_scale)
+            writer.write(frame)
+            time_now = time.time()
+            planner.report(tag, (time_now - frame_start) * 1000)
+            if time_now - time_logged >= 1.0:
+                print('Recorded {} of {} frames ({:.02f} frames/s)'.format(
+                    i + 1, len(cameras), (i + 1) / (time_now - time_start)),
+                      file=sys.stderr)
+                time_logged = time_now
+    finally:
+        writer.close()
+    time_total = time.time() - time_start
+    print('Recorded {} frames of {}x{} to {} in {:.02f} s ({:.02f} frames/s)'.format(
+        len(cameras), frame_size[0], frame_size[1], path, time_total,
+        len(cameras) / max(time_total, 1e-9)), file=sys.stderr)
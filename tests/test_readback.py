@@ -0,0 +1,113 @@
+import sys
+import os.path
+import threading
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import futracer
+
+try:
+    import pyopencl
+    import pyopencl.array
+except ImportError:
+    pyopencl = None
+
+
+class Library:
+    # Just enough of a futracerlib for FutRacer.from_device.
+    def __init__(self, queue=None):
+        self.queue = queue
+
+
+def make_racer(library):
+    # Skip loading a real library.
+    racer = futracer.FutRacer.__new__(futracer.FutRacer)
+    racer.futhark = futracer.LockedLibrary(library)
+    racer.backend = 'opencl'
+    return racer
+
+
+class Event:
+    def __init__(self, racer):
+        self.racer = racer
+        self.lock_free = None
+
+    def wait(self):
+        # The lock must be released while waiting, so check from another
+        # thread whether it can be taken.
+        def check():
+            self.lock_free = self.racer.futhark.lock.acquire(blocking=False)
+            if self.lock_free:
+                self.racer.futhark.lock.release()
+        thread = threading.Thread(target=check)
+        thread.start()
+        thread.join()
+
+
+class Array:
+    # The readback interface of pyopencl.array.Array since 2019.1.2: get only
+    # returns the array, and get_async returns the array and the event of the
+    # copy, or None for an empty array.
+    def __init__(self, racer, xs):
+        self.racer = racer
+        self.xs = xs
+        self.events = []
+
+    def get(self, queue=None, ary=None):
+        if ary is None:
+            ary = numpy.empty_like(self.xs)
+        ary[...] = self.xs
+        return ary
+
+    def get_async(self, queue=None, ary=None):
+        ary = self.get(queue, ary)
+        event = Event(self.racer) if self.xs.size > 0 else None
+        self.events.append(event)
+        return ary, event
+
+
+class TestFromDevice(unittest.TestCase):
+    def test_waits_for_the_copy_outside_the_lock(self):
+        racer = make_racer(Library())
+        xs = Array(racer, numpy.arange(12, dtype='uint32').reshape(3, 4))
+        out = numpy.zeros((3, 4), dtype='uint32')
+        result = racer.from_device(xs, out=out)
+        self.assertIs(result, out)
+        numpy.testing.assert_array_equal(out, xs.xs)
+        self.assertTrue(xs.events[0].lock_free)
+
+    def test_allocates_without_out(self):
+        racer = make_racer(Library())
+        xs = Array(racer, numpy.arange(5, dtype='float32'))
+        numpy.testing.assert_array_equal(racer.from_device(xs), xs.xs)
+
+    def test_empty_array(self):
+        racer = make_racer(Library())
+        xs = Array(racer, numpy.zeros((0,), dtype='float32'))
+        self.assertEqual(len(racer.from_device(xs)), 0)
+        self.assertEqual(xs.events, [None])
+
+
+@unittest.skipIf(pyopencl is None, 'pyopencl is not installed')
+class TestFromDevicePyOpenCL(unittest.TestCase):
+    def test_readback(self):
+        try:
+            context = pyopencl.create_some_context(interactive=False)
+        except Exception as e:
+            self.skipTest('no OpenCL device: {}'.format(e))
+        queue = pyopencl.CommandQueue(context)
+        racer = make_racer(Library(queue))
+        xs = numpy.arange(640 * 360, dtype='uint32').reshape(640, 360)
+        xs_dev = pyopencl.array.to_device(queue, xs)
+        out = numpy.empty_like(xs)
+        racer.from_device(xs_dev, out=out)
+        numpy.testing.assert_array_equal(out, xs)
+        empty_dev = pyopencl.array.to_device(queue, xs[:0])
+        self.assertEqual(len(racer.from_device(empty_dev)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()